@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# Copyright (C) 2011-2012 Kostiantyn Danylov aka koder <koder.mail@gmail.com>
+#
+# This file is part of tiny_cloud library.
+#
+# tiny_cloud is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# tiny_cloud is distrubuted in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with tiny_cloud; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA.
+
+"""measure cli startup: wall time and slowest imports per command
+
+usage: bench_startup.py [-c cloud.yaml] [-n runs] [cmd ...]
+each command runs in fresh interpreter with --no-daemon"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+
+# executed in child interpreter: wraps __import__ to record
+# cumulative import time of every module, then runs cli main
+CHILD = """
+import sys, time, json, __builtin__
+
+real_import = __builtin__.__import__
+import_times = {}
+
+def timed_import(name, *args, **kwargs):
+    if name in sys.modules:
+        return real_import(name, *args, **kwargs)
+    start = time.time()
+    try:
+        return real_import(name, *args, **kwargs)
+    finally:
+        import_times.setdefault(name, time.time() - start)
+
+__builtin__.__import__ = timed_import
+start = time.time()
+sys.path.insert(0, sys.argv[1])
+import main
+try:
+    code = main.main(sys.argv[3:])
+except SystemExit as exc:
+    code = exc.code
+sys.stdout.flush()
+res = {'code': code, 'total': time.time() - start, 'imports': import_times}
+open(sys.argv[2], 'w').write(json.dumps(res))
+"""
+
+
+def run_once(cmd_args, res_fname):
+    "returns result, recorded by CHILD, or None if it crashed"
+    if os.path.exists(res_fname):
+        os.unlink(res_fname)
+
+    with open(os.devnull, 'w') as devnull:
+        subprocess.call([sys.executable, '-c', CHILD, os.path.dirname(os.path.abspath(__file__)),
+                         res_fname] + cmd_args, stdout=devnull, stderr=devnull)
+    if not os.path.exists(res_fname):
+        return None
+
+    with open(res_fname) as fd:
+        return json.load(fd)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', default=None)
+    parser.add_argument('-n', '--runs', default=5, type=int)
+    parser.add_argument('-t', '--top', default=5, type=int,
+                        help="Show that many slowest imports")
+    parser.add_argument('cmds', nargs='*', default=['vms', 'xml', 'list'])
+    opts = parser.parse_args(argv)
+
+    res_fname = "/tmp/tcloud_bench_{0}.json".format(os.getpid())
+    try:
+        for cmd in opts.cmds:
+            cmd_args = ['--no-daemon'] + cmd.split()
+            if opts.config is not None:
+                cmd_args = ['-c', opts.config] + cmd_args
+
+            runs = []
+            for _ in range(opts.runs):
+                wall_start = time.time()
+                res = run_once(cmd_args, res_fname)
+                if res is not None:
+                    res['wall'] = time.time() - wall_start
+                    runs.append(res)
+
+            if runs == []:
+                print "{0:<20} crashed".format(cmd)
+                continue
+
+            best = min(runs, key=lambda res: res['wall'])
+            print "{0:<20} wall {1:7.1f} ms  in main {2:7.1f} ms  exit code {3}".format(
+                        cmd, best['wall'] * 1000, best['total'] * 1000, best['code'])
+
+            slowest = sorted(best['imports'].items(), key=lambda item: -item[1])
+            for name, itime in slowest[:opts.top]:
+                print "    {0:<30} {1:7.1f} ms".format(name, itime * 1000)
+    finally:
+        if os.path.exists(res_fname):
+            os.unlink(res_fname)
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main(sys.argv[1:]))
@@ -3,3 +3,25 @@
 
 class CloudError(RuntimeError):
     "Common type for cloud exception"
+
+
+class TaskResult(object):
+    "Outcome of one per-vm operation"
+
+    def __init__(self, name, result=None, error=None, time=0.0):
+        self.name = name
+        self.result = result
+        self.error = error
+        self.time = time
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __str__(self):
+        if self.ok:
+            return "{0}: ok in {1:.2f}s".format(self.name, self.time)
+        return "{0}: failed in {1:.2f}s - {2}".format(self.name, self.time, self.error)
+
+    def __repr__(self):
+        return "TaskResult({0!r}, ok={1!r})".format(self.name, self.ok)
@@ -0,0 +1,210 @@
+# Copyright (C) 2011-2012 Kostiantyn Danylov aka koder <koder.mail@gmail.com>
+#
+# This file is part of tiny_cloud library.
+#
+# tiny_cloud is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# tiny_cloud is distrubuted in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with tiny_cloud; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA.
+
+"""tcloud daemon - keeps cloud, connections and caches warm between cli calls
+
+Protocol - one json line per connection from cli, many lines back:
+    request:  {"argv": [cli args], "config": abs path to cloud.yaml}
+    response: {"out": text} and {"err": text} lines as command prints
+              them, then {"code": exit code, "err": text}
+code is null, if daemon can't execute command and cli must run it itself
+"""
+
+import os
+import sys
+import json
+import errno
+import signal
+import socket
+import threading
+import SocketServer
+
+from utils import logger
+from common import CloudError
+
+
+DEFAULT_SOCKET = os.path.expanduser("~/.tcloud/tcloud.sock")
+
+
+class Refused(CloudError):
+    "raised by handler for commands, which cli must execute itself"
+
+
+class ResponseStream(object):
+    "file-like object, which sends every complete line to cli at once"
+
+    def __init__(self, wfile, name, lock):
+        self.wfile = wfile
+        self.name = name
+        self.lock = lock
+        self.buff = ""
+
+    def send(self, msg):
+        with self.lock:
+            try:
+                self.wfile.write(json.dumps(msg) + "\n")
+                self.wfile.flush()
+            except socket.error as err:
+                # cli went away - command still runs to the end
+                logger.debug("Can't send response - {0}".format(err))
+
+    def write(self, data):
+        self.buff += data
+        if "\n" in self.buff:
+            pos = self.buff.rindex("\n") + 1
+            data, self.buff = self.buff[:pos], self.buff[pos:]
+            self.send({self.name: data})
+
+    def flush(self):
+        if self.buff != "":
+            data, self.buff = self.buff, ""
+            self.send({self.name: data})
+
+
+class RequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if line == "":
+            # liveness check
+            return
+
+        lock = threading.Lock()
+        out = ResponseStream(self.wfile, 'out', lock)
+        err = ResponseStream(self.wfile, 'err', lock)
+        msg = ""
+
+        try:
+            req = json.loads(line)
+            code = self.server.handler([str(arg) for arg in req['argv']],
+                                       req.get('config'), out, err)
+        except Refused as exc:
+            code, msg = None, str(exc) + "\n"
+        except SystemExit as exc:
+            # argparse error
+            code, msg = exc.code, "Bad command line\n"
+        except Exception as exc:
+            logger.debug("Request failed", exc_info=True)
+            code, msg = 1, "{0}: {1}\n".format(exc.__class__.__name__, exc)
+
+        out.flush()
+        err.flush()
+        out.send({'code': code, 'err': msg})
+
+    def finish(self):
+        try:
+            SocketServer.StreamRequestHandler.finish(self)
+        except socket.error:
+            pass
+
+
+class CloudDaemon(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """Serves cli commands on unix socket
+
+    handler(argv, config, out, err) -> exit code executes command,
+    writing its output to out and err. It raises Refused for
+    commands, which should be executed by cli"""
+
+    daemon_threads = True
+
+    def __init__(self, sock_path, handler):
+        self.sock_path = sock_path
+        self.handler = handler
+
+        if daemon_call(sock_path, None, None) is not None:
+            raise CloudError("Daemon already listen on " + sock_path)
+
+        if os.path.exists(sock_path):
+            # stale socket from died daemon
+            os.unlink(sock_path)
+        elif not os.path.isdir(os.path.dirname(sock_path)):
+            os.makedirs(os.path.dirname(sock_path))
+
+        old_umask = os.umask(0177)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, sock_path, RequestHandler)
+        finally:
+            os.umask(old_umask)
+
+    def run(self):
+        "serve till SIGINT or SIGTERM"
+        logger.info("Daemon listen on " + self.sock_path)
+        signal.signal(signal.SIGTERM, stop_on_signal)
+        try:
+            self.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.server_close()
+            os.unlink(self.sock_path)
+
+
+def stop_on_signal(signum, frame):
+    raise KeyboardInterrupt()
+
+
+def daemon_call(sock_path, argv, config, out=None, err=None):
+    """pass cli command to daemon, command output is written to out
+    and err as soon as daemon sends it
+
+    returns exit code or None if no daemon is running or daemon
+    refused request, so command must be executed in process.
+    argv == None only checks, that daemon is alive"""
+    out = sys.stdout if out is None else out
+    err = sys.stderr if err is None else err
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(sock_path)
+        except socket.error as exc:
+            if exc.errno in (errno.ENOENT, errno.ECONNREFUSED):
+                return None
+            raise
+
+        if argv is None:
+            return 0
+
+        sock.sendall(json.dumps({'argv': argv, 'config': config}) + "\n")
+        fd = sock.makefile('rb')
+        try:
+            got_output = False
+            for line in iter(fd.readline, ""):
+                msg = json.loads(line)
+                if 'code' in msg:
+                    break
+                stream = out if 'out' in msg else err
+                stream.write(msg.get('out', msg.get('err')))
+                stream.flush()
+                got_output = True
+            else:
+                if got_output:
+                    err.write("Daemon on {0} closed connection\n".format(sock_path))
+                    return 1
+                logger.warning("Daemon on {0} closed connection - run in process".format(sock_path))
+                return None
+        finally:
+            fd.close()
+    finally:
+        sock.close()
+
+    if msg['code'] is None:
+        logger.debug("Daemon refused command: " + msg['err'].strip())
+        return None
+
+    err.write(msg['err'])
+    return msg['code']
@@ -17,20 +17,32 @@
 # 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA.
 
 import os
+import re
+import sys
+import json
+import time
+import tarfile
+import StringIO
+import hashlib
+import tempfile
 import uuid
 import glob
 import crypt
+import fcntl
+import errno
+import ctypes
 import random
+import Queue
+import cPickle
+import threading
 import subprocess
 import contextlib
+import multiprocessing
 
-try:
-    import guestfs
-    no_guestfs = False
-except ImportError:
-    no_guestfs = True
+# imported on first use by load_guestfs
+guestfs = None
 
-from utils import netsz2netmask, ip2int, int2ip, logger
+from utils import netsz2netmask, ip2int, int2ip, logger, atomic_write
 from common import CloudError
 
 
@@ -38,6 +50,263 @@ def run(cmd):
     return subprocess.check_output(cmd, shell=True)
 
 
+qemu_img_size_re = re.compile(r"virtual size: .*?\((?P<size>\d+) bytes\)")
+
+
+def qemu_img_info(path):
+    """returns {'format': ..., 'virtual_size': ..., 'backing_chain': [[path, format], ...]}
+    for image path"""
+    try:
+        out = subprocess.check_output(['qemu-img', 'info', '--output=json',
+                                       '--backing-chain', path],
+                                      stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError:
+        # qemu-img before 1.5 - no json output
+        out = subprocess.check_output(['qemu-img', 'info', path])
+        info = {'format': None, 'virtual_size': None, 'backing_chain': []}
+        for line in out.split('\n'):
+            if line.startswith("file format: "):
+                info['format'] = line[len("file format: "):].strip()
+            elif line.startswith("backing file: "):
+                info['backing_chain'].append([line[len("backing file: "):].split(' (')[0].strip(), None])
+            elif qemu_img_size_re.match(line):
+                info['virtual_size'] = int(qemu_img_size_re.match(line).group('size'))
+    else:
+        chain = json.loads(out)
+        if isinstance(chain, dict):
+            chain = [chain]
+        info = {'format': str(chain[0]['format']),
+                'virtual_size': chain[0]['virtual-size'],
+                'backing_chain': [[str(img['filename']), str(img['format'])]
+                                  for img in chain[1:]]}
+
+    if info['format'] is None:
+        raise CloudError("Can't get format of image {0!r}".format(path))
+    return info
+
+
+class ImageInfoCache(object):
+    """Persistent cache of qemu-img info results
+
+    Entries are keyed by image path and valid while device, inode, size
+    and mtime of the file, the path resolves to, stay the same - so cache
+    hit costs one stat call and no qemu-img run"""
+
+    def __init__(self, fname=None):
+        if fname is None:
+            fname = os.path.expanduser("~/.tcloud/image_info.json")
+        self.fname = fname
+        self.lock = threading.Lock()
+        self.entries = None
+
+    def load(self):
+        if self.entries is None:
+            try:
+                with open(self.fname) as fd:
+                    self.entries = json.load(fd)
+            except (IOError, ValueError):
+                self.entries = {}
+
+    def save(self):
+        try:
+            with atomic_write(self.fname) as fd:
+                json.dump(self.entries, fd)
+        except (IOError, OSError) as err:
+            logger.debug("Can't store image info cache - {0}".format(err))
+
+    def get(self, path, fstat=None):
+        if fstat is None:
+            fstat = os.stat(path)
+        identity = [fstat.st_dev, fstat.st_ino, fstat.st_size, fstat.st_mtime]
+
+        with self.lock:
+            self.load()
+            entry = self.entries.get(path)
+            if entry is not None and entry['identity'] == identity:
+                return entry['info']
+
+        logger.debug("Get image info for " + path)
+        info = qemu_img_info(path)
+
+        with self.lock:
+            self.entries[path] = {'identity': identity,
+                                  'resolved_path': os.path.realpath(path),
+                                  'info': info}
+            self.save()
+
+        return info
+
+
+image_info_cache = ImageInfoCache()
+
+
+def image_info(path, fstat=None):
+    "cached qemu_img_info, fstat is os.stat(path) result, if caller has it already"
+    return image_info_cache.get(path, fstat)
+
+
+FICLONE = 0x40049409
+SEEK_DATA = 3
+SEEK_HOLE = 4
+COPY_CHUNK = 64 * 1024 * 1024
+
+try:
+    libc = ctypes.CDLL(None, use_errno=True)
+    copy_file_range_c = libc.copy_file_range
+except (OSError, AttributeError):
+    # glibc < 2.27
+    copy_file_range_c = None
+else:
+    copy_file_range_c.restype = ctypes.c_ssize_t
+    copy_file_range_c.argtypes = [ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+                                  ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+                                  ctypes.c_size_t, ctypes.c_uint]
+
+
+class ProgressMeter(object):
+    "calls callback(done_bytes, total_bytes, bytes_per_second)"
+
+    def __init__(self, callback, total):
+        self.callback = callback
+        self.total = total
+        self.start = time.time()
+
+    def __call__(self, done):
+        if self.callback is not None:
+            dtime = time.time() - self.start
+            self.callback(done, self.total, done / dtime if dtime > 0 else 0.0)
+
+
+def data_segments(fd, size):
+    "yields (offset, length) of data areas in file, holes are skipped"
+    offset = 0
+    while offset < size:
+        try:
+            data = os.lseek(fd, offset, SEEK_DATA)
+        except OSError as err:
+            if err.errno == errno.ENXIO:
+                # only hole till the end of file
+                return
+            if err.errno == errno.EINVAL:
+                # no SEEK_DATA support - all file is data
+                yield offset, size - offset
+                return
+            raise
+        hole = min(os.lseek(fd, data, SEEK_HOLE), size)
+        yield data, hole - data
+        offset = hole
+
+
+def copy_range(src_fd, dst_fd, offset, length, done, meter):
+    "copy one data segment, using copy_file_range if available"
+    end = offset + length
+
+    if copy_file_range_c is not None:
+        off_in = ctypes.c_int64(offset)
+        off_out = ctypes.c_int64(offset)
+        while off_in.value < end:
+            copied = copy_file_range_c(src_fd, ctypes.byref(off_in), dst_fd, ctypes.byref(off_out),
+                                       min(COPY_CHUNK, end - off_in.value), 0)
+            if copied <= 0:
+                if copied < 0 and ctypes.get_errno() not in (errno.EXDEV, errno.ENOSYS,
+                                                             errno.EINVAL, errno.EOPNOTSUPP):
+                    err_no = ctypes.get_errno()
+                    raise OSError(err_no, os.strerror(err_no))
+                break
+            done += copied
+            meter(done)
+        offset = off_in.value
+
+    os.lseek(src_fd, offset, os.SEEK_SET)
+    os.lseek(dst_fd, offset, os.SEEK_SET)
+    while offset < end:
+        data = os.read(src_fd, min(COPY_CHUNK, end - offset))
+        if not data:
+            break
+        os.write(dst_fd, data)
+        offset += len(data)
+        done += len(data)
+        meter(done)
+
+    return done
+
+
+def copy_image(src_fname, dst_fname, progress=None):
+    """copy image file, keeping it sparse
+
+    reflinks file on CoW filesystems, else copies only data areas
+    with copy_file_range (in-kernel copy) or read/write.
+    progress is callback(done_bytes, total_bytes, bytes_per_second)"""
+    with open(src_fname, 'rb') as src, open(dst_fname, 'wb') as dst:
+        size = os.fstat(src.fileno()).st_size
+        meter = ProgressMeter(progress, size)
+
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        except (IOError, OSError):
+            pass
+        else:
+            meter(size)
+            return
+
+        done = 0
+        for offset, length in data_segments(src.fileno(), size):
+            done = copy_range(src.fileno(), dst.fileno(), offset, length, done, meter)
+        os.ftruncate(dst.fileno(), size)
+        meter(size)
+
+
+qemu_img_progress_re = re.compile(r"\((?P<perc>\d+(\.\d+)?)/100%\)")
+
+
+qemu_img_convert_help_re = re.compile(r"convert .*\[-m \S+\].*\[-W\]")
+qemu_img_parallel = None
+
+
+def qemu_img_parallel_convert():
+    "True if qemu-img convert has -m and -W options (qemu-img 2.9+), checked once"
+    global qemu_img_parallel
+    if qemu_img_parallel is None:
+        try:
+            proc = subprocess.Popen(['qemu-img', '--help'], stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT)
+            out = proc.communicate()[0]
+        except OSError:
+            out = ""
+        qemu_img_parallel = qemu_img_convert_help_re.search(out) is not None
+        if not qemu_img_parallel:
+            logger.debug("qemu-img convert has no -m/-W - use sequential convert")
+    return qemu_img_parallel
+
+
+def qemu_img_convert(src_fname, src_format, dst_fname, dst_format,
+                     coroutines=8, progress=None):
+    """qemu-img convert with parallel coroutines and out-of-order writes,
+    if qemu-img supports them
+
+    progress is callback(done_bytes, total_bytes, bytes_per_second)"""
+    total = image_info(src_fname)['virtual_size'] if progress is not None else None
+    meter = ProgressMeter(progress, total)
+    cmd = ['qemu-img', 'convert', '-p']
+    if qemu_img_parallel_convert():
+        cmd.extend(['-m', str(coroutines), '-W'])
+    cmd.extend(['-f', src_format, '-O', dst_format, src_fname, dst_fname])
+
+    with tempfile.TemporaryFile() as err_fd:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=err_fd)
+        buff = ""
+        for data in iter(lambda: proc.stdout.read(64), ""):
+            buff += data
+            for match in qemu_img_progress_re.finditer(buff):
+                if total is not None:
+                    meter(int(total * float(match.group('perc')) / 100))
+            buff = buff[buff.rfind(')') + 1:]
+
+        if proc.wait() != 0:
+            err_fd.seek(0)
+            raise CloudError("{0} failed: {1}".format(" ".join(cmd), err_fd.read().strip()))
+
+
 @contextlib.contextmanager
 def make_image(src_fname,
                tempo_files_dir,
@@ -46,7 +315,12 @@ def make_image(src_fname,
                qcow2_preallocate=False,
                lvm_dev1=None,
                lvm_dev2=None,
-               delete_on_exit=True):
+               delete_on_exit=True,
+               progress=None,
+               coroutines=8):
+    """materialize src_fname (qcow2) image in dst_format, yields path to it
+
+    progress is callback(done_bytes, total_bytes, bytes_per_second)"""
 
     bstore_raw = None
     is_bstore_dev = False
@@ -73,9 +347,8 @@ def make_image(src_fname,
         rm_files = [dst_fname]
         is_dst_dev = False
 
-    convert = lambda cmd: \
-                    run("qemu-img convert -f qcow2 -O {0} {1} {2}".format(\
-                                cmd, src_fname, dst_fname))
+    convert = lambda cmd: qemu_img_convert(src_fname, 'qcow2', dst_fname, cmd,
+                                           coroutines, progress)
 
     opts = ""
 
@@ -88,7 +361,7 @@ def make_image(src_fname,
         opts = opts + " -c "
 
     if dst_format == 'qcow2':
-        run('cp {0} {1}'.format(src_fname, dst_fname))
+        copy_image(src_fname, dst_fname, progress)
     elif dst_format == 'qcow':
         convert('qcow')
     elif dst_format == 'raw':
@@ -105,7 +378,7 @@ def make_image(src_fname,
         else:
             frmt = 'raw'
 
-        run("qemu-img convert -f qcow2 -O {0} {1} {2}".format(frmt, src_fname, bstore_raw))
+        qemu_img_convert(src_fname, 'qcow2', bstore_raw, frmt, coroutines, progress)
         run("qemu-img create {0} -f qcow2 -o backing_fmt=raw,backing_file={1} {2}".format(
                             opts, bstore_raw, dst_fname))
 
@@ -119,6 +392,153 @@ def make_image(src_fname,
             map(os.unlink, rm_files)
 
 
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno != errno.ESRCH
+    return True
+
+
+class OverlayPool(object):
+    """Ready to use qcow2 overlays for base images
+
+    Keeps up to size overlays per base image in spool directory.
+    take hands out one of them and background thread creates
+    replacement, so vm start doesn't wait for qemu-img.
+
+    Spool may be shared by several processes (cli and daemon): overlay
+    is claimed by rename to name with owner pid, only one process
+    refills base at a time (flock) and half-written files are named
+    with pid too, so only files of dead processes are cleaned up"""
+
+    def __init__(self, spool, bases, size=2):
+        self.spool = spool
+        self.bases = [os.path.abspath(base) for base in bases]
+        self.size = size
+        self.lock = threading.Lock()
+        self.refill_thread = None
+
+        for base in self.bases:
+            bdir = self.base_dir(base)
+            if not os.path.isdir(bdir):
+                os.makedirs(bdir)
+            self.clean_stale(bdir)
+
+        self.start_refill()
+
+    def base_dir(self, base):
+        return os.path.join(self.spool, hashlib.sha1(base).hexdigest()[:16])
+
+    def __contains__(self, base):
+        return os.path.abspath(base) in self.bases
+
+    @staticmethod
+    def clean_stale(bdir):
+        "remove tmp and claimed files, left by dead processes"
+        for fname in glob.glob(os.path.join(bdir, '*.*.tmp')) + \
+                     glob.glob(os.path.join(bdir, '*.*.claimed')):
+            try:
+                pid = int(fname.rsplit('.', 2)[1])
+            except ValueError:
+                continue
+            if not pid_alive(pid):
+                logger.debug("Remove stale overlay " + fname)
+                try:
+                    os.unlink(fname)
+                except OSError:
+                    pass
+
+    def ready(self, base):
+        return sorted(glob.glob(os.path.join(self.base_dir(base), '*.qcow2')))
+
+    def make_overlay(self, base, dst_dir=None):
+        if dst_dir is None:
+            dst_dir = self.base_dir(base)
+        fname = os.path.join(dst_dir, str(uuid.uuid1()))
+        tmp_fname = "{0}.{1}.tmp".format(fname, os.getpid())
+        backing_opts = "backing_file={0},backing_fmt={1}".format(base, image_info(base)['format'])
+        try:
+            subprocess.check_output(['qemu-img', 'create', '-f', 'qcow2', '-o', backing_opts,
+                                     tmp_fname])
+            os.rename(tmp_fname, fname + '.qcow2')
+        except:
+            if os.path.exists(tmp_fname):
+                os.unlink(tmp_fname)
+            raise
+        return fname + '.qcow2'
+
+    def refill_base(self, base):
+        lock_fd = os.open(os.path.join(self.base_dir(base), '.lock'), os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as err:
+                if err.errno in (errno.EAGAIN, errno.EACCES):
+                    # other process refills this base
+                    return
+                raise
+
+            while len(self.ready(base)) < self.size:
+                self.make_overlay(base)
+        finally:
+            os.close(lock_fd)
+
+    def refill(self):
+        for base in self.bases:
+            try:
+                self.refill_base(base)
+            except (subprocess.CalledProcessError, OSError, IOError, CloudError) as err:
+                logger.error("Can't create overlay for {0} - {1}".format(base, err))
+
+    def start_refill(self):
+        with self.lock:
+            if self.refill_thread is None or not self.refill_thread.is_alive():
+                self.refill_thread = threading.Thread(target=self.refill)
+                self.refill_thread.start()
+
+    def claim(self, base):
+        "atomically take ready overlay of base from spool, returns its new name or None"
+        for fname in self.ready(base):
+            claimed = "{0}.{1}.claimed".format(fname[:-len('.qcow2')], os.getpid())
+            try:
+                os.rename(fname, claimed)
+            except OSError as err:
+                if err.errno == errno.ENOENT:
+                    # taken by other process
+                    continue
+                raise
+            return claimed
+        return None
+
+    def take(self, base, dst):
+        "move ready overlay of base image to dst and returns dst"
+        base = os.path.abspath(base)
+        fname = self.claim(base)
+
+        if fname is None:
+            logger.warning("No ready overlay for {0} - create it now".format(base))
+            fname = self.make_overlay(base, os.path.dirname(os.path.abspath(dst)))
+
+        try:
+            os.rename(fname, dst)
+        except OSError as err:
+            if err.errno != errno.EXDEV:
+                raise
+            # spool is on other filesystem - overlay is small, copy it
+            copy_image(fname, dst + '.tmp')
+            os.rename(dst + '.tmp', dst)
+            os.unlink(fname)
+
+        self.start_refill()
+        return dst
+
+    def close(self):
+        "wait till pool is refilled"
+        if self.refill_thread is not None:
+            self.refill_thread.join()
+
+
 class LocalGuestFS(object):
     def __init__(self, root):
         self.root = root
@@ -135,56 +555,701 @@ class LocalGuestFS(object):
     def exists(self, path):
         return os.path.exists(self.path(path))
 
+    def is_file(self, path):
+        return os.path.isfile(self.path(path))
+
     def rm(self, path):
         path = self.path(path)
         if os.path.exists(path):
             return os.unlink(path)
 
     def mkdir_p(self, path):
-        cp = self.root
-        path_els = path.split(path[1:], '/')
-        for el in path_els:
-            cp = os.path.join(cp, el)
-            os.mkdir(cp)
+        if not os.path.isdir(self.path(path)):
+            os.makedirs(self.path(path))
+
+
+class GuestEditPlan(object):
+    """Collects guest fs edits and applies them at once on commit
+
+    Each file is read from guest at most once. All writes go in one tar
+    upload for libguestfs, or, for LocalGuestFS, are written to temporary
+    files, fsynced as one batch and atomically renamed into place"""
+
+    def __init__(self, gfs):
+        self.gfs = gfs
+        self.files = {}
+        self.writes = {}
+        self.write_order = []
+        self.dirs = []
+        self.removes = []
+        # calls, made to plan, and calls, which plan made to gfs
+        self.calls = 0
+        self.round_trips = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def read_file(self, path):
+        self.calls += 1
+        if path in self.writes:
+            return self.writes[path]
+
+        if path not in self.files:
+            self.round_trips += 1
+            self.files[path] = self.gfs.read_file(path)
+            self.bytes_read += len(self.files[path])
+        return self.files[path]
+
+    def is_file(self, path):
+        self.calls += 1
+        if path in self.writes or path in self.files:
+            return True
+        self.round_trips += 1
+        return self.gfs.is_file(path)
+
+    def exists(self, path):
+        self.calls += 1
+        if path in self.writes or path in self.files or path in self.dirs:
+            return True
+        self.round_trips += 1
+        return self.gfs.exists(path)
+
+    def write(self, path, data):
+        self.calls += 1
+        if path not in self.writes:
+            self.write_order.append(path)
+        self.writes[path] = data
+
+    def mkdir_p(self, path):
+        self.calls += 1
+        self.dirs.append(path)
+
+    def rm(self, path):
+        self.calls += 1
+        self.removes.append(path)
+
+    def commit(self):
+        if isinstance(self.gfs, LocalGuestFS):
+            self.commit_local()
+        else:
+            self.commit_guestfs()
+
+        self.bytes_written = sum(len(data) for data in self.writes.values())
+        logger.debug("Guest edit plan applied: {0} calls in {1} round trips, "
+                     "{2} bytes read, {3} bytes written".format(
+                        self.calls, self.round_trips, self.bytes_read, self.bytes_written))
+
+    def guest_stats(self, paths):
+        "returns {path: (mode, uid, gid)} for existing paths, one call per directory"
+        by_dir = {}
+        for path in paths:
+            by_dir.setdefault(os.path.dirname(path), []).append(os.path.basename(path))
+
+        lstatlist = getattr(self.gfs, 'lstatnslist', None) or self.gfs.lstatlist
+        res = {}
+        for dname, names in by_dir.items():
+            self.round_trips += 1
+            for name, fstat in zip(names, lstatlist(dname, names)):
+                if fstat['st_ino' if 'st_ino' in fstat else 'ino'] != -1:
+                    res[os.path.join(dname, name)] = (
+                        fstat.get('st_mode', fstat.get('mode')) & 0o7777,
+                        fstat.get('st_uid', fstat.get('uid')),
+                        fstat.get('st_gid', fstat.get('gid')))
+        return res
+
+    def commit_guestfs(self):
+        fstats = self.guest_stats(self.write_order)
+        ctime = time.time()
+
+        with tempfile.NamedTemporaryFile(suffix='.tar') as tar_fd:
+            with contextlib.closing(tarfile.open(fileobj=tar_fd, mode='w')) as tar:
+                for path in self.dirs:
+                    info = tarfile.TarInfo(path.lstrip('/'))
+                    info.type = tarfile.DIRTYPE
+                    info.mode = 0o755
+                    info.mtime = ctime
+                    tar.addfile(info)
+
+                for path in self.write_order:
+                    data = self.writes[path]
+                    info = tarfile.TarInfo(path.lstrip('/'))
+                    info.size = len(data)
+                    info.mode, info.uid, info.gid = fstats.get(path, (0o644, 0, 0))
+                    info.mtime = ctime
+                    tar.addfile(info, StringIO.StringIO(data))
+            tar_fd.flush()
+
+            self.round_trips += 1
+            self.gfs.tar_in(tar_fd.name, '/')
+
+        for path in self.removes:
+            self.round_trips += 1
+            self.gfs.rm_f(path)
+
+    def commit_local(self):
+        for path in self.dirs:
+            self.round_trips += 1
+            self.gfs.mkdir_p(path)
+
+        tmp_files = []
+        try:
+            for path in self.write_order:
+                fname = self.gfs.path(path)
+                tmp_fname = "{0}.tcloud-{1}".format(fname, os.getpid())
+                with open(tmp_fname, 'w') as fd:
+                    tmp_files.append((tmp_fname, fname))
+                    fd.write(self.writes[path])
+
+                if os.path.exists(fname):
+                    fstat = os.stat(fname)
+                    os.chmod(tmp_fname, fstat.st_mode & 0o7777)
+                    os.chown(tmp_fname, fstat.st_uid, fstat.st_gid)
+
+            for tmp_fname, _ in tmp_files:
+                fd = os.open(tmp_fname, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+
+            for tmp_fname, fname in tmp_files:
+                self.round_trips += 1
+                os.rename(tmp_fname, fname)
+            tmp_files = []
+        finally:
+            for tmp_fname, _ in tmp_files:
+                if os.path.exists(tmp_fname):
+                    os.unlink(tmp_fname)
+
+        for path in self.removes:
+            self.round_trips += 1
+            self.gfs.rm(path)
+
+
+PREPARE_VERSION = 1
+PREPARE_SECTIONS = ('hostname', 'net', 'users', 'ssh')
+
+
+class PrepareFingerprint(object):
+    """Sidecar <image>.tcloud.json with hashes of prepare_guest inputs
+
+    Valid while image file has the same device and inode (in place
+    writes keep them, new copy of image gets new inode) and was made
+    by the same PREPARE_VERSION. Stores only salted hashes - no passwords"""
+
+    def __init__(self, disk_path, hostname, passwords, eth_devs):
+        self.disk_path = disk_path
+        self.fname = disk_path + '.tcloud.json'
+        self.inputs = {
+            'hostname': hostname,
+            'net': sorted((dev, list(params)) for dev, params in eth_devs.items()),
+            'users': sorted(passwords.items()),
+            'ssh': None,
+        }
+        self.salt = uuid.uuid4().hex
+
+    def sections(self):
+        return dict((name, hashlib.sha256(self.salt + json.dumps(val)).hexdigest())
+                    for name, val in self.inputs.items())
+
+    def identity(self):
+        fstat = os.stat(self.disk_path)
+        return [fstat.st_dev, fstat.st_ino]
+
+    def changed_sections(self):
+        "sections, which need to be rewritten in image"
+        try:
+            with open(self.fname) as fd:
+                stored = json.load(fd)
+        except (IOError, ValueError):
+            return PREPARE_SECTIONS
+
+        if stored.get('version') != PREPARE_VERSION or \
+                stored.get('identity') != self.identity():
+            return PREPARE_SECTIONS
+
+        self.salt = str(stored['salt'])
+        old = stored.get('sections', {})
+        new = self.sections()
+        return tuple(name for name in PREPARE_SECTIONS if old.get(name) != new[name])
+
+    def save(self):
+        data = {'version': PREPARE_VERSION,
+                'identity': self.identity(),
+                'salt': self.salt,
+                'sections': self.sections()}
+        try:
+            with atomic_write(self.fname) as fd:
+                json.dump(data, fd)
+        except (IOError, OSError) as err:
+            logger.debug("Can't store prepare fingerprint for {0} - {1}"
+                         .format(self.disk_path, err))
+
+
+def close_guestfs(gfs):
+    "flush changes to images and stop appliance"
+    if hasattr(gfs, 'shutdown'):
+        gfs.shutdown()
+    gfs.close()
+
+
+def load_guestfs():
+    "import guestfs, raises CloudError if it isn't installed"
+    global guestfs
+    if guestfs is None:
+        try:
+            import guestfs as guestfs_module
+        except ImportError:
+            raise CloudError("No libguestfs found. Can't manage vm images")
+        guestfs = guestfs_module
+    return guestfs
 
 
 def prepare_guest(*dt, **mp):
-    if no_guestfs:
-        raise CloudError("No libguestfs found. Can't manage vm images")
+    if mp.get('format') != 'nbd':
+        load_guestfs()
     return prepare_guest_debian(*dt, **mp)
 
 
-@contextlib.contextmanager
-def mount_dimage(image, mdir):
+def root_devices(gfs, root):
+    """whole devices, which hold os root filesystem
 
-    for dev in glob.glob('/dev/nbd*'):
-        if not os.path.exists('/sys/block/{dev}/pid'.format(dev.split('/')[-1])):
-            break
+    root on LVM lives on all physical volumes of its volume group"""
+    try:
+        return [gfs.part_to_dev(root)]
+    except RuntimeError:
+        pass
+
+    if not gfs.is_lv(root):
+        return [root]
+
+    vg_name = gfs.lvm_canonical_lv_name(root).split('/')[2]
+    vg_pvs = set(gfs.vgpvuuids(vg_name))
+    devs = []
+    for pv in gfs.pvs():
+        if gfs.pvuuid(pv) in vg_pvs:
+            try:
+                devs.append(gfs.part_to_dev(pv))
+            except RuntimeError:
+                # pv on whole device
+                devs.append(pv)
+    return devs
+
+
+def prepare_guests_batch(jobs):
+    """Prepare images of many vm's in one libguestfs appliance
+
+    jobs is list of (disk_paths, hostname, passwords, eth_devs). All
+    disks of all jobs are attached at once, root filesystem of a job is
+    searched among its disks, so data images can be passed along with
+    system one. Returns list of None or (is_cloud_error, message) - one per job"""
+    load_guestfs()
+
+    fprints = []
+    sections = []
+    for disk_paths, hostname, passwords, eth_devs in jobs:
+        fprints.append(PrepareFingerprint(disk_paths[0], hostname, passwords, eth_devs))
+        sections.append(fprints[-1].changed_sections())
+
+    if not any(sections):
+        return [None] * len(jobs)
+
+    gfs = guestfs.GuestFS()
+    drive_jobs = []
+    for pos, (disk_paths, hostname, _, _) in enumerate(jobs):
+        if not sections[pos]:
+            logger.info("Images {0} are already prepared - skip them".format(", ".join(disk_paths)))
+            continue
+        logger.info("Prepare image for " + hostname)
+        for disk_path in disk_paths:
+            gfs.add_drive_opts(disk_path)
+            drive_jobs.append(pos)
+
+    logger.debug("Launch libguestfs vm for {0} drives".format(len(drive_jobs)))
+    gfs.launch()
+
+    # devices are listed in the order, drives were added
+    dev_jobs = dict(zip(gfs.list_devices(), drive_jobs))
+    job_roots = [[] for _ in jobs]
+    for root in gfs.inspect_os():
+        root_jobs = set(dev_jobs.get(dev) for dev in root_devices(gfs, root))
+        if len(root_jobs) == 1 and None not in root_jobs:
+            job_roots[root_jobs.pop()].append(root)
+        else:
+            logger.warning("Can't find image for os root {0} - skip it".format(root))
 
-    if os.path.exists('/sys/block/{dev}/pid'.format(dev.split('/')[-1])):
-        msg = "Can't found free nbd device"
-        logger.error(msg)
-        raise CloudError(msg)
+    results = []
+    for (disk_paths, hostname, passwords, eth_devs), roots, job_sections in \
+            zip(jobs, job_roots, sections):
+        if not job_sections:
+            results.append(None)
+            continue
+
+        images = ", ".join(disk_paths)
+        try:
+            if len(roots) != 1:
+                raise CloudError("Found {0} os roots in images {1} - disk prepare impossible"
+                                 .format(len(roots), images))
+            mount_guest_root(gfs, roots[0], images)
+            configure_guest(gfs, hostname, passwords, eth_devs, job_sections)
+            results.append(None)
+        except CloudError as err:
+            results.append((True, str(err)))
+        except Exception as err:
+            logger.debug("Preparation of {0} failed".format(images), exc_info=True)
+            results.append((False, "{0}: {1}".format(err.__class__.__name__, err)))
+        finally:
+            gfs.umount_all()
+
+    close_guestfs(gfs)
+    for fprint, res in zip(fprints, results):
+        if res is None:
+            fprint.save()
+
+    return results
 
-    cmd = "qemu-nbd -c {dev} {img}".format(dev=dev, image=image)
-    subprocess.check_call(cmd, shell=True)
 
+def prepare_worker(params):
+    """prepare_guest entry point for worker processes
+
+    returns None on success or (is_cloud_error, message)"""
+    disk_path, hostname, passwords, eth_devs, format = params
     try:
-        for pdev in glob.glob(dev + 'p*'):
-            subprocess.check_call('mount {dev} {mdir}'.format(dev=dev, mdir=mdir))
-            if os.path.exists(os.path.isdir(mdir, 'etc')):
+        prepare_guest(disk_path, hostname, passwords, eth_devs, format=format)
+    except CloudError as err:
+        return (True, str(err))
+    except Exception as err:
+        logger.debug("Image preparation failed", exc_info=True)
+        return (False, "{0}: {1}".format(err.__class__.__name__, err))
+    return None
+
+
+def prepare_batch_worker(jobs):
+    "prepare_guests_batch entry point for worker processes"
+    try:
+        return prepare_guests_batch(jobs)
+    except CloudError as err:
+        return [(True, str(err))] * len(jobs)
+    except Exception as err:
+        logger.debug("Batch image preparation failed", exc_info=True)
+        return [(False, "{0}: {1}".format(err.__class__.__name__, err))] * len(jobs)
+
+
+def prepare_workers_count(appliance_mem=768 * 1024 ** 2):
+    "how many libguestfs appliances host can run at once"
+    workers = multiprocessing.cpu_count()
+    try:
+        meminfo = {}
+        with open('/proc/meminfo') as fd:
+            for line in fd:
+                name, val = line.split(':', 1)
+                meminfo[name] = int(val.split()[0]) * 1024
+        avail = meminfo.get('MemAvailable',
+                            meminfo['MemFree'] + meminfo.get('Cached', 0))
+        workers = min(workers, avail // appliance_mem)
+    except (IOError, KeyError, ValueError):
+        pass
+    return max(1, workers)
+
+
+class PreparedImage(object):
+    "handle for image preparation, running in worker process"
+
+    # keep wait interruptible by Ctrl-C
+    max_wait = 24 * 3600
+
+    def __init__(self, disk_path, async_res, batch_pos=None):
+        self.disk_path = disk_path
+        self.async_res = async_res
+        self.batch_pos = batch_pos
+
+    def wait(self):
+        "raises CloudError if preparation failed"
+        res = self.async_res.get(self.max_wait)
+        if self.batch_pos is not None:
+            res = res[self.batch_pos]
+        if res is not None:
+            is_cloud_error, msg = res
+            msg = "Can't prepare image {0} - {1}".format(self.disk_path, msg)
+            if is_cloud_error:
+                raise CloudError(msg)
+            raise RuntimeError(msg)
+
+
+class WorkerResult(object):
+    "result of task, running in PrepareWorker"
+
+    def __init__(self):
+        self.ready = threading.Event()
+        self.value = None
+        self.error = None
+
+    def set(self, value, error=None):
+        self.value = value
+        self.error = error
+        self.ready.set()
+
+    def get(self, timeout):
+        if not self.ready.wait(timeout):
+            raise CloudError("Image preparation timeout")
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class PrepareWorker(object):
+    """disk_image.py, running in clean interpreter as worker process
+
+    Worker is started with fork + exec, so it doesn't inherit locks,
+    held by threads of caller. Tasks are taken from shared queue by
+    feeder thread and passed to worker over pipe, see worker_main"""
+
+    def __init__(self, tasks):
+        script = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+        self.proc = subprocess.Popen([sys.executable, script],
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     close_fds=True)
+        self.thread = threading.Thread(target=self.feed, args=(tasks,))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def feed(self, tasks):
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            func_name, args, result = task
+            try:
+                cPickle.dump((func_name, args), self.proc.stdin, 2)
+                self.proc.stdin.flush()
+                result.set(cPickle.load(self.proc.stdout))
+            except (IOError, EOFError, cPickle.UnpicklingError) as err:
+                result.set(None, RuntimeError("Prepare worker failed - {0}".format(err)))
+
+    def close(self):
+        self.thread.join()
+        self.proc.stdin.close()
+        self.proc.wait()
+
+
+WORKER_FUNCS = {'prepare': prepare_worker,
+                'prepare_batch': prepare_batch_worker}
+
+
+def worker_main():
+    "PrepareWorker loop: pickled (func name, args) from stdin, pickled result to stdout"
+    # libguestfs and logging may print - keep stdout for results only
+    out = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    while True:
+        try:
+            func_name, args = cPickle.load(sys.stdin)
+        except EOFError:
+            break
+        cPickle.dump(WORKER_FUNCS[func_name](args), out, 2)
+        out.flush()
+
+
+class PreparePool(object):
+    """Runs prepare_guest for many images in parallel worker processes
+
+    Worker count is limited by host cpu count and memory, available
+    for libguestfs appliances. Workers are fresh interpreters, not
+    forks - caller may run threads or be a daemon"""
+
+    def __init__(self, workers=None):
+        if workers is None:
+            workers = prepare_workers_count()
+        self.workers = workers
+        self.tasks = Queue.Queue()
+        self.procs = None
+
+    def apply_async(self, func_name, args):
+        if self.procs is None:
+            logger.debug("Start {0} image preparation workers".format(self.workers))
+            self.procs = [PrepareWorker(self.tasks) for _ in range(self.workers)]
+        result = WorkerResult()
+        self.tasks.put((func_name, args, result))
+        return result
+
+    def submit(self, disk_path, hostname, passwords, eth_devs, format=None):
+        "returns PreparedImage, which wait method blocks till image is ready"
+        params = (disk_path, hostname, passwords, eth_devs, format)
+        return PreparedImage(disk_path, self.apply_async('prepare', params))
+
+    def submit_batch(self, jobs):
+        """prepare all jobs in one shared appliance, see prepare_guests_batch
+
+        returns list of PreparedImage - one per job"""
+        async_res = self.apply_async('prepare_batch', jobs)
+        return [PreparedImage(", ".join(job[0]), async_res, pos)
+                for pos, job in enumerate(jobs)]
+
+    def close(self):
+        "wait for submitted tasks and stop workers"
+        if self.procs is not None:
+            for _ in self.procs:
+                self.tasks.put(None)
+            for proc in self.procs:
+                proc.close()
+            self.procs = None
+
+
+class NBDAllocator(object):
+    """Hands out free /dev/nbdN devices to concurrent users
+
+    Device is claimed by flock on per-device lock file, so processes
+    never race for the same device. Devices, connected by someone else
+    (have /sys/block/nbdN/pid), are skipped"""
+
+    def __init__(self, lock_dir=None):
+        if lock_dir is None:
+            lock_dir = '/run/lock/tcloud-nbd' if os.path.isdir('/run/lock') else '/tmp/tcloud-nbd'
+        self.lock_dir = lock_dir
+
+    @staticmethod
+    def devices():
+        devs = [dev for dev in glob.glob('/dev/nbd*') if re.match(r'/dev/nbd\d+$', dev)]
+        return sorted(devs, key=lambda dev: int(dev[len('/dev/nbd'):]))
+
+    @staticmethod
+    def is_busy(dev):
+        return os.path.exists('/sys/block/{0}/pid'.format(os.path.basename(dev)))
+
+    def acquire(self):
+        "returns (dev, lock_fd)"
+        if not os.path.isdir(self.lock_dir):
+            try:
+                os.makedirs(self.lock_dir)
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+
+        for dev in self.devices():
+            lock_fd = os.open(os.path.join(self.lock_dir, os.path.basename(dev) + '.lock'),
+                              os.O_CREAT | os.O_RDWR, 0666)
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                os.close(lock_fd)
+                continue
+
+            if not self.is_busy(dev):
+                return dev, lock_fd
+            self.release(lock_fd)
+
+        msg = "Can't found free nbd device (is nbd module loaded?)"
+        logger.error(msg)
+        raise CloudError(msg)
+
+    @staticmethod
+    def release(lock_fd):
+        fcntl.flock(lock_fd, fcntl.LOCK_UN)
+        os.close(lock_fd)
+
+    @staticmethod
+    def wait_partitions(dev, timeout, poll=0.05):
+        """wait till kernel reads partition table of just connected dev
+        and udev creates partition nodes, returns partition devs
+
+        qemu-nbd returns before partition uevents are queued, so
+        sysfs is polled instead of 'udevadm settle'"""
+        name = os.path.basename(dev)
+        tend = time.time() + timeout
+        pttype = None
+        parts = []
+
+        while True:
+            if pttype is None:
+                with open('/sys/block/{0}/size'.format(name)) as fd:
+                    connected = int(fd.read()) != 0
+                if connected:
+                    proc = subprocess.Popen(['blkid', '-p', '-o', 'value', '-s', 'PTTYPE', dev],
+                                            stdout=subprocess.PIPE)
+                    pttype = proc.communicate()[0].strip()
+
+            if pttype == "":
+                # whole device filesystem
+                return []
+
+            if pttype is not None:
+                parts = sorted(os.path.basename(path) for path in
+                               glob.glob('/sys/block/{0}/{0}p*'.format(name)))
+                if parts and all(os.path.exists('/dev/' + part) for part in parts):
+                    return ['/dev/' + part for part in parts]
+
+            if time.time() >= tend:
                 break
-            subprocess.check_call("umount " + pdev)
+            time.sleep(poll)
+
+        logger.warning("Partitions of {0} didn't appear in {1}s".format(dev, timeout))
+        return ['/dev/' + part for part in parts if os.path.exists('/dev/' + part)]
 
-        if not os.path.exists(os.path.isdir(mdir, 'etc')):
+    @contextlib.contextmanager
+    def connect(self, image, format=None, timeout=10):
+        "connects image to free nbd device, yields (dev, [partition devs])"
+        dev, lock_fd = self.acquire()
+        try:
+            cmd = ['qemu-nbd', '--connect', dev]
+            if format is not None:
+                cmd.extend(['-f', format])
+            subprocess.check_call(cmd + [image])
+
+            try:
+                yield dev, self.wait_partitions(dev, timeout)
+            finally:
+                subprocess.call(['qemu-nbd', '--disconnect', dev])
+        finally:
+            self.release(lock_fd)
+
+
+nbd_allocator = NBDAllocator()
+
+ROOT_LABELS = ('cloudimg-rootfs', 'root', 'rootfs', '/')
+LINUX_FS = ('ext2', 'ext3', 'ext4', 'xfs', 'btrfs', 'jfs', 'reiserfs')
+
+
+def blkid_info(devs):
+    "{dev: {'TYPE': ..., 'LABEL': ...}} for all devs in one blkid call"
+    proc = subprocess.Popen(['blkid', '-o', 'export'] + list(devs), stdout=subprocess.PIPE)
+    out = proc.communicate()[0]
+
+    res = {}
+    for block in out.strip().split('\n\n'):
+        attrs = dict(line.split('=', 1) for line in block.split('\n') if '=' in line)
+        if 'DEVNAME' in attrs:
+            res[attrs['DEVNAME']] = attrs
+    return res
+
+
+def root_candidates(dev, parts):
+    "linux filesystems on dev, most probable root first"
+    devs_info = blkid_info(parts or [dev])
+    cands = [name for name, attrs in devs_info.items() if attrs.get('TYPE') in LINUX_FS]
+    is_root_label = lambda name: devs_info[name].get('LABEL') in ROOT_LABELS or \
+                                 devs_info[name].get('PARTLABEL') in ROOT_LABELS
+    return sorted(cands, key=lambda name: (not is_root_label(name), name))
+
+
+@contextlib.contextmanager
+def mount_dimage(image, mdir, format=None):
+    "mount root fs of image on mdir through nbd device, yields LocalGuestFS"
+    with nbd_allocator.connect(image, format) as (dev, parts):
+        for pdev in root_candidates(dev, parts):
+            if subprocess.call(['mount', pdev, mdir]) != 0:
+                logger.debug("Can't mount {0} of {1} - try next".format(pdev, image))
+                continue
+            if os.path.isdir(os.path.join(mdir, 'etc')):
+                break
+            subprocess.check_call(['umount', pdev])
+        else:
             raise CloudError("Can't found root partition in file " + image)
 
         try:
             yield LocalGuestFS(mdir)
         finally:
-            subprocess.call('umount ' + pdev)
-    finally:
-        subprocess.check_call("qemu-nbd -d " + dev, shell=True)
+            subprocess.call(['umount', pdev])
+
 
 ifconfig_script = \
 """
@@ -214,6 +1279,22 @@ def prepare_guest_debian(disk_path, hostname, passwords, eth_devs, format=None,
             else:
                 interfaces.append("ifconfig {0} {1}/{2} up".format(dev, ip, sz))
         gfs.write('/etc/init/lxc_lan.conf', ifconfig_script.format("\n".join(interfaces)))
+        configure_guest(gfs, hostname, passwords, eth_devs)
+        return
+
+    fprint = PrepareFingerprint(disk_path, hostname, passwords, eth_devs)
+    sections = fprint.changed_sections()
+    if not sections:
+        logger.info("Image {0} is already prepared - skip it".format(disk_path))
+        return
+
+    if format == 'nbd':
+        mdir = tempfile.mkdtemp(prefix='tcloud-')
+        try:
+            with mount_dimage(disk_path, mdir) as gfs:
+                configure_guest(gfs, hostname, passwords, eth_devs, sections)
+        finally:
+            os.rmdir(mdir)
     else:
         gfs = guestfs.GuestFS()
         gfs.add_drive_opts(disk_path, format=format)
@@ -227,41 +1308,69 @@ def prepare_guest_debian(disk_path, hostname, passwords, eth_devs, format=None,
             logger.error(msg)
             raise CloudError(msg)
 
-        # for dev, fs_type in  gfs.list_filesystems():
-        #     logger.debug("Fount partition {0} with fs type {1}".format(dev, fs_type))
+        if 0 == len(os_devs):
+            msg = "Can't found os in image " + disk_path
+            logger.error(msg)
+            raise CloudError(msg)
 
-        #     # TODO: add lvm support
-        #     if fs_type in 'ext2 ext3 reiserfs3 reiserfs4 xfs jfs btrfs':
-        #         gfs.mount(dev, '/')
-        #         if gfs.exists('/etc'):
-        #             logger.debug("Fount /etc on partition {0} - will work on it".format(dev))
-        #             break
-        #         gfs.umount(dev)
-        #         logger.debug("No /etc dir found - continue")
+        mount_guest_root(gfs, os_devs[0], disk_path)
+        configure_guest(gfs, hostname, passwords, eth_devs, sections)
+        close_guestfs(gfs)
 
-        if 0 == len(os_devs):
-            mounts = sorted(gfs.inspect_get_mountpoints(os_devs[0]))
+    fprint.save()
 
-            for mpoint, dev in mounts:
-                gfs.mount(dev, mpoint)
 
-                if not gfs.exists('/etc'):
-                    msg = "Can't fount /etc dir in image " + disk_path
-                    logger.error(msg)
-                    raise CloudError(msg)
-        else:
-            gfs.mount(os_devs[0], '/')
-            #gfs.mount('/dev/vda1', '/')
+def mount_guest_root(gfs, root, disk_path):
+    gfs.mount(root, '/')
 
-            if not gfs.exists('/etc'):
-                msg = "Can't fount /etc dir in image " + disk_path
-                logger.error(msg)
-                raise CloudError(msg)
+    if not gfs.exists('/etc'):
+        msg = "Can't fount /etc dir in image " + disk_path
+        logger.error(msg)
+        raise CloudError(msg)
+
+
+def configure_guest(guest_fs, hostname, passwords, eth_devs, sections=None):
+    """set hostname, network, users and ssh access in mounted guest fs
+
+    sections limits changes to some of PREPARE_SECTIONS, all by default.
+    returns applied GuestEditPlan"""
+    gfs = GuestEditPlan(guest_fs)
+    if sections is None:
+        sections = PREPARE_SECTIONS
 
-    logger.debug("Launch ok. Set hostname")
-    #hostname
+    if 'hostname' in sections:
+        configure_hostname(gfs, hostname)
+
+    if 'net' in sections:
+        configure_net(gfs, eth_devs)
+
+    if 'users' in sections:
+        configure_users(gfs, passwords)
+
+    if 'ssh' in sections:
+        configure_ssh(gfs)
+
+    gfs.commit()
+    return gfs
+
+
+def configure_hostname(gfs, hostname):
+    logger.debug("Set hostname")
     gfs.write('/etc/hostname', hostname)
 
+    logger.debug("Update hosts")
+
+    hosts = gfs.read_file('/etc/hosts')
+
+    new_hosts = ["127.0.0.1 localhost\n127.0.0.1 " + hostname]
+    for ln in hosts.split('#'):
+        if not ln.strip().startswith('127.0.0.1'):
+            new_hosts.append(ln)
+
+    gfs.write('/etc/hosts', "\n".join(new_hosts))
+
+
+def configure_net(gfs, eth_devs):
     #set device names
     logger.debug("Set device names and network imterfaces")
     templ = 'SUBSYSTEM=="net", DRIVERS=="?*", ATTR{{address}}=="{hw}", NAME="{name}"'
@@ -285,6 +1394,8 @@ def prepare_guest_debian(disk_path, hostname, passwords, eth_devs, format=None,
     # gfs.write('/etc/network/interfaces', "\n".join(interfaces))
     gfs.write('/etc/network/interfaces.d/eth0', "\n".join(interfaces))
 
+
+def configure_users(gfs, passwords):
     # update passwords
     logger.debug("Update passwords")
 
@@ -331,8 +1442,8 @@ def prepare_guest_debian(disk_path, hostname, passwords, eth_devs, format=None,
         ln = ln.strip()
         if ln != '' and ln[0] != '#':
             logins.append(ln.split(':', 1)[0])
-            ids.append(ln.split(':')[2])
-            ids.append(ln.split(':')[3])
+            ids.append(int(ln.split(':')[2]))
+            ids.append(int(ln.split(':')[3]))
 
     add_lines = []
     try:
@@ -356,17 +1467,8 @@ def prepare_guest_debian(disk_path, hostname, passwords, eth_devs, format=None,
     #     fc = 'Acquire::http {{ Proxy "http://{0}:3142"; }};'.format(apt_proxy_ip)
     #     gfs.write('/etc/apt/apt.conf.d/02proxy', fc)
 
-    logger.debug("Update hosts")
-
-    hosts = gfs.read_file('/etc/hosts')
-
-    new_hosts = ["127.0.0.1 localhost\n127.0.0.1 " + hostname]
-    for ln in hosts.split('#'):
-        if not ln.strip().startswith('127.0.0.1'):
-            new_hosts.append(ln)
-
-    gfs.write('/etc/hosts', "\n".join(new_hosts))
 
+def configure_ssh(gfs):
     # allow ssh passwd auth
     if gfs.is_file('/etc/ssh/ssh_config'):
         name = '/etc/ssh/ssh_config'
@@ -377,7 +1479,7 @@ def prepare_guest_debian(disk_path, hostname, passwords, eth_devs, format=None,
         name = None
 
     if name is not None:
-        sshd_conf = gfs.read_file('/etc/ssh/ssh_config')
+        sshd_conf = gfs.read_file(name)
         sshd_conf_lines = sshd_conf.split("\n")
         for pos, ln in enumerate(sshd_conf_lines):
             if "PasswordAuthentication" in ln:
@@ -385,5 +1487,8 @@ def prepare_guest_debian(disk_path, hostname, passwords, eth_devs, format=None,
                 break
         else:
             sshd_conf_lines.append("PasswordAuthentication yes")
-        gfs.write('/etc/ssh/ssh_config', "\n".join(sshd_conf_lines))
+        gfs.write(name, "\n".join(sshd_conf_lines))
+
 
+if __name__ == "__main__":
+    worker_main()
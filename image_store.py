@@ -0,0 +1,160 @@
+# Copyright (C) 2011-2012 Kostiantyn Danylov aka koder <koder.mail@gmail.com>
+#
+# This file is part of tiny_cloud library.
+#
+# tiny_cloud is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# tiny_cloud is distrubuted in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with tiny_cloud; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA.
+
+"""content addressed store of base images"""
+
+import os
+import mmap
+import hashlib
+import subprocess
+import multiprocessing
+
+from utils import logger, run_parallel
+from common import CloudError
+from disk_image import image_info, copy_image
+
+
+HASH_CHUNK = 16 * 1024 * 1024
+
+
+def hash_file(fname, chunk_size=HASH_CHUNK, workers=None):
+    """sha256 tree hash of file
+
+    chunks of mmap-ed file are hashed in threads (hashlib releases
+    GIL for big buffers), result is hash of chunk digests"""
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    with open(fname, 'rb') as fd:
+        size = os.fstat(fd.fileno()).st_size
+        top = hashlib.sha256("tcloud-tree-v1:{0}:{1}:".format(chunk_size, size))
+        if size == 0:
+            return top.hexdigest()
+
+        mem = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            hash_chunk = lambda offset: hashlib.sha256(buffer(mem, offset, chunk_size)).digest()
+            results = run_parallel(hash_chunk, range(0, size, chunk_size), workers)
+        finally:
+            mem.close()
+
+    for res in results:
+        if not res.ok:
+            raise CloudError("Can't hash {0}: {1}".format(fname, res.error))
+        top.update(res.result)
+
+    return top.hexdigest()
+
+
+class ImageStore(object):
+    """Base images, stored once by content digest under root/bases
+
+    Per-vm images are turned into thin qcow2 overlays on shared
+    base, so vm's share disk space and page cache for same data"""
+
+    def __init__(self, root, hash_workers=None):
+        self.root = os.path.abspath(root)
+        self.bases_dir = os.path.join(root, 'bases')
+        self.hash_workers = hash_workers
+
+    def base_path(self, digest):
+        return os.path.join(self.bases_dir, digest)
+
+    def bases(self):
+        "digest => path for all stored bases"
+        if not os.path.isdir(self.bases_dir):
+            return {}
+        return dict((fname, self.base_path(fname))
+                    for fname in os.listdir(self.bases_dir)
+                    if not fname.endswith('.tmp'))
+
+    def add(self, fname):
+        "store copy of image, if it isn't stored yet. Returns path to stored base"
+        digest = hash_file(fname, workers=self.hash_workers)
+        path = self.base_path(digest)
+
+        if not os.path.exists(path):
+            if not os.path.isdir(self.bases_dir):
+                os.makedirs(self.bases_dir)
+            logger.debug("Store new base {0} from {1}".format(digest, fname))
+            copy_image(fname, path + '.tmp')
+            os.chmod(path + '.tmp', 0444)
+            os.rename(path + '.tmp', path)
+
+        return path
+
+    def make_thin(self, fname, base):
+        """replace image with qcow2 overlay on stored base, which holds
+        only clusters, different from base. Image must not be in use"""
+        base_fmt = image_info(base)['format']
+        tmp_fname = fname + '.tcloud.tmp'
+
+        cmd = ['qemu-img', 'convert', '-O', 'qcow2', '-B', base, '-F', base_fmt,
+               fname, tmp_fname]
+        try:
+            subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError as err:
+            if os.path.exists(tmp_fname):
+                os.unlink(tmp_fname)
+            raise CloudError("{0} failed: {1}".format(" ".join(cmd), err.output.strip()))
+
+        os.rename(tmp_fname, fname)
+
+    def dedup(self, fnames, base_fname=None):
+        """store base_fname (first image by default) and turn all
+        fnames into overlays on it. Returns path to stored base"""
+        fnames = [os.path.abspath(fname) for fname in fnames]
+        base_fname = fnames[0] if base_fname is None else os.path.abspath(base_fname)
+        base = self.add(base_fname)
+
+        for fname in fnames:
+            if os.path.realpath(base) in self.backing_files(fname):
+                continue
+            logger.debug("Rebase {0} on {1}".format(fname, base))
+            self.make_thin(fname, base)
+
+        return base
+
+    @staticmethod
+    def backing_files(fname):
+        return [os.path.realpath(path) for path, _ in image_info(fname)['backing_chain']]
+
+    def gc(self, images, dry_run=False):
+        """remove bases, which aren't any of images or in their backing chains
+
+        all images must exist - base of missing one can't be detected
+        and would be removed. Returns list of removed (or, with
+        dry_run, to be removed) paths"""
+        missing = [fname for fname in images if not os.path.exists(fname)]
+        if missing:
+            raise CloudError("Images {0} don't exist - gc refused, as their bases are unknown"
+                             .format(", ".join(missing)))
+
+        used = set()
+        for fname in images:
+            used.add(os.path.realpath(fname))
+            used.update(self.backing_files(fname))
+
+        removed = []
+        for digest, path in sorted(self.bases().items()):
+            if os.path.realpath(path) not in used:
+                if not dry_run:
+                    logger.debug("Remove unused base " + digest)
+                    os.unlink(path)
+                removed.append(path)
+        return removed
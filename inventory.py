@@ -0,0 +1,276 @@
+# Copyright (C) 2011-2012 Kostiantyn Danylov aka koder <koder.mail@gmail.com>
+#
+# This file is part of tiny_cloud library.
+#
+# tiny_cloud is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# tiny_cloud is distrubuted in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with tiny_cloud; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA.
+
+"""vm's and networks from cloud config - no libvirt or other heavy imports"""
+
+import re
+import os
+import hashlib
+import cPickle
+
+from utils import ip2int, int2ip, netsz2netmask, logger, atomic_write
+
+CONFIG_CACHE_DIR = os.path.expanduser("~/.tcloud/cache")
+CONFIG_CACHE_VERSION = 2
+
+
+class NIC(object):
+    "vm network interface, parsed from 'ethN: mac, ip, network' config line"
+    __slots__ = ('name', 'mac', 'ip', 'network')
+
+    # checked in this order, first full match wins
+    param_res = [('mac', re.compile(':'.join([r"[\da-fA-F][\da-fA-F]"] * 6) + "$")),
+                 ('ip', re.compile(r"\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$")),
+                 ('network', re.compile(r"[a-zA-Z_][-\w_]*$"))]
+
+    def __init__(self, name, mac=None, ip=None, network='default'):
+        self.name = name
+        self.mac = mac
+        self.ip = ip
+        self.network = network
+
+    @classmethod
+    def parse(cls, name, line):
+        nic = cls(name)
+        for param in line.split(','):
+            param = param.strip()
+            for attr, param_re in cls.param_res:
+                if param_re.match(param):
+                    setattr(nic, attr, param)
+                    break
+            else:
+                raise ValueError("Can't categorize network parameter {0!r}".format(param))
+        return nic
+
+    def __str__(self):
+        return "NIC({0!r}, {1!r}, {2!r}, {3!r})".format(self.name, self.mac,
+                                                        self.ip, self.network)
+
+    def __repr__(self):
+        return str(self)
+
+
+class VM(object):
+    """vm from cloud config
+
+    not known config keys are available as attributes too"""
+    __slots__ = ('name', 'mem', 'htype', 'vcpu', 'user', 'passwd',
+                 'images', 'opts', 'nics', 'extra')
+
+    eth_re = re.compile(r"eth(\d+)$")
+
+    def __init__(self, name, **keys):
+        self.name = name
+        self.mem = int(keys.pop('mem', 1024))
+        self.htype = keys.pop('htype', 'kvm')
+        self.vcpu = int(keys.pop('vcpu', 1))
+
+        credentials = keys.pop('credentials', 'root:root')
+        self.user, self.passwd = credentials.split(':')
+        if 'image' in keys:
+            self.images = [keys.pop('image')]
+        else:
+            self.images = keys.pop('images')
+        self.opts = [i.strip() for i in keys.pop('opts', "").split()]
+
+        eths = sorted((int(self.eth_re.match(key).group(1)), key)
+                      for key in keys if self.eth_re.match(key))
+        self.nics = [NIC.parse(key, keys.pop(key)) for _, key in eths]
+        self.extra = keys
+
+    def __getattr__(self, name):
+        # called only for attributes, missing in slots
+        if name == 'extra':
+            raise AttributeError(name)
+        try:
+            return self.extra[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def eths(self):
+        return self.nics
+
+    def __str__(self):
+        return "VM({0!r})".format(self.name)
+
+    def __repr__(self):
+        return str(self)
+
+
+class Network(object):
+    def __init__(self, name, **data):
+        ip_range = data['range']
+        self.ip1, ip2_sz = ip_range.split('-')
+        self.ip2, self.sz = ip2_sz.split('/')
+        self.ip1 = self.ip1.strip()
+        self.ip2 = self.ip2.strip()
+        self.sz = int(self.sz)
+        self.url = data.get('url', 'qemu:///system')
+
+        self.name = name
+        self.ip = int2ip(ip2int(self.ip1) + 1)
+        self.bridge = data['bridge'].strip()
+        self.netmask = netsz2netmask(self.sz)
+
+
+def load_vms(vms, prefix="", separator='.'):
+    """name => VM for vms section of cloud config
+
+    nested sections with 'type: network' are vm groups, names of their
+    vm's are prefixed with group name and separator"""
+    res = {}
+    for k, v in vms.items():
+        if not isinstance(v, (dict, VM)):
+            continue
+
+        if isinstance(v, VM):
+            # already compiled
+            res[prefix + k] = v
+        elif v.get('type', 'vm') == 'network':
+            res.update(load_vms(v, prefix + k + separator, separator))
+        else:
+            res[prefix + k] = VM(prefix + k, **v)
+    return res
+
+
+class Inventory(object):
+    """name => VM map with indexes for group, mac and network lookups
+
+    groups maps every group prefix ('a' and 'a.b' for vm 'a.b.c')
+    to names of its vm's, by_mac maps upper case mac to (vm, nic),
+    by_network maps network name to vm's with nic in it"""
+
+    def __init__(self, vms=None, separator='.'):
+        self.separator = separator
+        self.vms = {}
+        self.groups = {}
+        self.by_mac = {}
+        self.by_network = {}
+        if vms is not None:
+            self.update(vms)
+
+    def add(self, vm):
+        if vm.name in self.vms:
+            self.remove(vm.name)
+
+        self.vms[vm.name] = vm
+        parts = vm.name.split(self.separator)
+        for pos in range(1, len(parts)):
+            self.groups.setdefault(self.separator.join(parts[:pos]), []).append(vm.name)
+
+        for nic in vm.nics:
+            if nic.mac is not None:
+                self.by_mac[nic.mac.upper()] = (vm, nic)
+            self.by_network.setdefault(nic.network, []).append(vm)
+
+    def remove(self, name):
+        vm = self.vms.pop(name)
+        parts = name.split(self.separator)
+        for pos in range(1, len(parts)):
+            self.groups[self.separator.join(parts[:pos])].remove(name)
+
+        for nic in vm.nics:
+            if nic.mac is not None:
+                self.by_mac.pop(nic.mac.upper(), None)
+            self.by_network[nic.network].remove(vm)
+
+    def update(self, vms):
+        for vm in vms.values():
+            self.add(vm)
+
+    def find(self, name):
+        "vm name or all vm's of group name"
+        res = [self.vms[vm_name] for vm_name in self.groups.get(name, [])]
+        if name in self.vms:
+            res.append(self.vms[name])
+        return res
+
+    def __getitem__(self, name):
+        return self.vms[name]
+
+    def __contains__(self, name):
+        return name in self.vms
+
+    def __iter__(self):
+        return iter(self.vms)
+
+    def __len__(self):
+        return len(self.vms)
+
+    def keys(self):
+        return self.vms.keys()
+
+    def values(self):
+        return self.vms.values()
+
+    def items(self):
+        return self.vms.items()
+
+
+def parse_config(data):
+    "yaml.load with libyaml C loader, if pyyaml is built with it"
+    import yaml
+    return yaml.load(data, Loader=getattr(yaml, 'CLoader', yaml.Loader))
+
+
+def compile_config(data, separator='.'):
+    "cloud config with vms and networks sections turned into name => VM/Network"
+    cfg = parse_config(data)
+    cfg['vms'] = Inventory(load_vms(cfg['vms'], separator=separator), separator)
+    cfg['networks'] = dict((name, Network(name, **net))
+                           for name, net in cfg['networks'].items())
+    return cfg
+
+
+def read_config(cfg_fname):
+    """returns (text, key) of config file
+
+    key changes on every edit - it's path, mtime and content hash"""
+    cfg_fname = os.path.abspath(cfg_fname)
+    with open(cfg_fname) as fd:
+        data = fd.read()
+        mtime = os.fstat(fd.fileno()).st_mtime
+    return data, [CONFIG_CACHE_VERSION, cfg_fname, mtime, hashlib.sha1(data).hexdigest()]
+
+
+def load_config(cfg_fname, cache_dir=CONFIG_CACHE_DIR):
+    """compile_config for file, cached in cache_dir as pickle
+
+    cache entry is valid for the same key, as read_config returns"""
+    cfg_fname = os.path.abspath(cfg_fname)
+    data, key = read_config(cfg_fname)
+    cache_fname = os.path.join(cache_dir, hashlib.sha1(cfg_fname).hexdigest() + '.pickle')
+
+    try:
+        with open(cache_fname, 'rb') as fd:
+            entry_key, cfg = cPickle.load(fd)
+        if entry_key == key:
+            return cfg
+    except Exception as err:
+        # no cache, broken cache, or cache from other code version
+        logger.debug("Config cache miss for {0} - {1}".format(cfg_fname, err))
+
+    cfg = compile_config(data)
+
+    try:
+        with atomic_write(cache_fname, 'wb', dir_mode=0700) as fd:
+            cPickle.dump((key, cfg), fd, cPickle.HIGHEST_PROTOCOL)
+    except (IOError, OSError) as err:
+        logger.debug("Can't store config cache - {0}".format(err))
+
+    return cfg
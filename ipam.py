@@ -0,0 +1,300 @@
+# Copyright (C) 2011-2012 Kostiantyn Danylov aka koder <koder.mail@gmail.com>
+#
+# This file is part of tiny_cloud library.
+#
+# tiny_cloud is free software; you can redistribute it and/or modify it under the
+# terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# tiny_cloud is distrubuted in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with tiny_cloud; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA.
+
+"""ip address management for cloud networks"""
+
+import os
+import json
+import threading
+
+from utils import ip2int, int2ip, logger, file_lock, atomic_write
+from common import CloudError
+
+
+# FIRST_ZERO[byte] - position of lowest zero bit in byte, 8 for 0xFF
+FIRST_ZERO = bytearray(next((bit for bit in range(8) if not byte & (1 << bit)), 8)
+                       for byte in range(256))
+
+
+class IPConflict(CloudError):
+    pass
+
+
+class Bitmap(object):
+    "set of integers in [0, size), with fast search for free one"
+
+    def __init__(self, size):
+        self.size = size
+        self.bits = bytearray((size + 7) // 8)
+        self.used = 0
+
+    def __contains__(self, pos):
+        return bool(self.bits[pos >> 3] & (1 << (pos & 7)))
+
+    def set(self, pos):
+        if pos not in self:
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+            self.used += 1
+
+    def clear(self, pos):
+        if pos in self:
+            self.bits[pos >> 3] &= ~(1 << (pos & 7)) & 0xFF
+            self.used -= 1
+
+    def find_free(self, start, stop):
+        "first free position in [start, stop) or None. Full bytes are skipped at once"
+        pos = start
+        while pos < stop:
+            byte = self.bits[pos >> 3]
+            if byte == 0xFF:
+                pos = (pos | 7) + 1
+                continue
+            # mask out bits below pos in this byte
+            bit = FIRST_ZERO[byte | ((1 << (pos & 7)) - 1)]
+            if bit < 8:
+                free = (pos & ~7) + bit
+                return free if free < stop else None
+            pos = (pos | 7) + 1
+        return None
+
+
+class IPPool(object):
+    """Addresses of one subnet
+
+    Any address of subnet can be reserved, new addresses are
+    allocated only from [first, last] range. owners maps ip => owner
+    for reserved and allocated addresses"""
+
+    def __init__(self, first, last, netsz):
+        mask = (0xFFFFFFFF << (32 - netsz)) & 0xFFFFFFFF
+        self.net = ip2int(first) & mask
+        self.first = ip2int(first) - self.net
+        self.last = ip2int(last) - self.net
+        self.used = Bitmap(1 << (32 - netsz))
+        self.owners = {}
+        self.hint = self.first
+        self.free = self.last - self.first + 1
+
+        # network and broadcast addresses
+        self.mark(0)
+        self.mark(self.used.size - 1)
+
+    def in_range(self, off):
+        return self.first <= off <= self.last
+
+    def mark(self, off):
+        if off not in self.used:
+            self.used.set(off)
+            if self.in_range(off):
+                self.free -= 1
+
+    def unmark(self, off):
+        if off in self.used:
+            self.used.clear(off)
+            if self.in_range(off):
+                self.free += 1
+
+    def offset(self, ip):
+        off = ip2int(ip) - self.net
+        if not 0 <= off < self.used.size:
+            raise CloudError("Address {0} is out of subnet {1}".format(ip, int2ip(self.net)))
+        return off
+
+    def owner(self, ip):
+        return self.owners.get(ip)
+
+    def reserve(self, ip, owner):
+        "mark ip as used by owner, raises IPConflict if other owner uses it"
+        off = self.offset(ip)
+        if off in self.used:
+            current = self.owners.get(ip)
+            if current == owner:
+                return
+            raise IPConflict("Address {0} of {1} is already used by {2}".format(ip, owner, current))
+        self.mark(off)
+        self.owners[ip] = owner
+
+    def release(self, ip):
+        self.unmark(self.offset(ip))
+        self.owners.pop(ip, None)
+
+    def find_free(self):
+        off = self.used.find_free(self.hint, self.last + 1)
+        if off is None and self.hint != self.first:
+            off = self.used.find_free(self.first, self.hint)
+        return off
+
+    def allocate(self, owner):
+        off = self.find_free()
+        if off is None:
+            raise CloudError("No free addresses in {0}-{1}".format(int2ip(self.net + self.first),
+                                                                   int2ip(self.net + self.last)))
+        ip = int2ip(self.net + off)
+        self.mark(off)
+        self.owners[ip] = owner
+        self.hint = off + 1 if off < self.last else self.first
+        return ip
+
+    def allocate_many(self, owners):
+        "allocate ip for each owner - all or nothing. returns {owner: ip}"
+        if self.free < len(owners):
+            raise CloudError("Only {0} free addresses, {1} requested".format(self.free, len(owners)))
+
+        res = {}
+        try:
+            for owner in owners:
+                res[owner] = self.allocate(owner)
+        except CloudError:
+            for ip in res.values():
+                self.release(ip)
+            raise
+        return res
+
+
+class IPAM(object):
+    """IPPool per cloud network, allocations are stored in json file
+
+    Static addresses from config are reserved on every start and
+    aren't stored, so removing them from config frees them. File is
+    shared by all processes: allocate and release reread it under
+    flock, so concurrent processes never hand out the same address"""
+
+    def __init__(self, fname=None):
+        if fname is None:
+            fname = os.path.expanduser("~/.tcloud/ipam.json")
+        self.fname = fname
+        self.pools = {}
+        self.lock = threading.Lock()
+        self.stored = self.read()
+
+    def read(self):
+        try:
+            with open(self.fname) as fd:
+                return json.load(fd)
+        except (IOError, ValueError):
+            return {}
+
+    def add_network(self, network):
+        "network is inventory.Network"
+        pool = IPPool(network.ip1, network.ip2, network.sz)
+        pool.reserve(network.ip, 'bridge:' + network.name)
+
+        stored = self.stored.setdefault(network.name, {})
+        for ip, owner in sorted(stored.items()):
+            try:
+                pool.reserve(str(ip), str(owner))
+            except CloudError as err:
+                logger.warning("Drop stored allocation - {0}".format(err))
+                del stored[ip]
+
+        self.pools[network.name] = pool
+
+    def reserve_static(self, inventory):
+        """reserve addresses of vm's nic's with static ip
+
+        returns list of (vm name, conflict message)"""
+        conflicts = []
+        for vm in sorted(inventory.values(), key=lambda vm: vm.name):
+            for nic in vm.nics:
+                if nic.ip is not None and nic.network in self.pools:
+                    try:
+                        self.pools[nic.network].reserve(nic.ip, "{0}:{1}".format(vm.name, nic.name))
+                    except CloudError as err:
+                        conflicts.append((vm.name, str(err)))
+        return conflicts
+
+    def sync(self):
+        "apply allocations and releases, made by other processes"
+        stored = self.read()
+        for netname, pool in self.pools.items():
+            old = self.stored.get(netname, {})
+            new = dict((str(ip), str(owner)) for ip, owner in stored.get(netname, {}).items())
+
+            for ip, owner in old.items():
+                if new.get(ip) != owner and pool.owner(ip) == owner:
+                    pool.release(ip)
+
+            for ip, owner in sorted(new.items()):
+                if old.get(ip) != owner:
+                    try:
+                        pool.reserve(ip, owner)
+                    except CloudError as err:
+                        logger.warning("Drop stored allocation - {0}".format(err))
+                        del new[ip]
+            stored[netname] = new
+        self.stored = stored
+
+    def save(self):
+        try:
+            with atomic_write(self.fname) as fd:
+                json.dump(self.stored, fd)
+        except (IOError, OSError) as err:
+            logger.error("Can't store ip allocations - {0}".format(err))
+
+    def get_pool(self, netname):
+        try:
+            return self.pools[netname]
+        except KeyError:
+            raise CloudError("Unknown network {0!r}".format(netname))
+
+    def allocate(self, netname, owners):
+        """allocate and store one address for each owner, returns {owner: ip}
+
+        owner, which already has address in network, gets it again"""
+        with self.lock, file_lock(self.fname):
+            self.sync()
+            pool = self.get_pool(netname)
+            stored = self.stored.setdefault(netname, {})
+            by_owner = dict((owner, ip) for ip, owner in stored.items())
+            res = dict((owner, by_owner[owner]) for owner in owners if owner in by_owner)
+            new = pool.allocate_many([owner for owner in owners if owner not in by_owner])
+            if new:
+                for owner, ip in new.items():
+                    stored[ip] = owner
+                self.save()
+            res.update(new)
+        return res
+
+    def release(self, netname, ips):
+        with self.lock, file_lock(self.fname):
+            self.sync()
+            pool = self.get_pool(netname)
+            stored = self.stored.setdefault(netname, {})
+            for ip in ips:
+                pool.release(ip)
+                stored.pop(ip, None)
+            self.save()
+
+    def release_stale(self, is_alive, prefix=""):
+        """release stored addresses of owners, which starts with prefix and
+        for which is_alive(owner without prefix) is False
+
+        returns list of released ips"""
+        with self.lock, file_lock(self.fname):
+            self.sync()
+            released = []
+            for netname, stored in self.stored.items():
+                for ip, owner in stored.items():
+                    if owner.startswith(prefix) and not is_alive(owner[len(prefix):]):
+                        if netname in self.pools:
+                            self.pools[netname].release(ip)
+                        del stored[ip]
+                        released.append(ip)
+            if released:
+                self.save()
+        return sorted(released)
@@ -26,36 +26,45 @@ import socket
 import os.path
 import logging
 import argparse
+import threading
+import functools
 
-import yaml
-
-from vm import TinyCloud
 from common import CloudError
-from utils import logger, logger_handler
+from daemon import CloudDaemon, Refused, daemon_call, DEFAULT_SOCKET
+from utils import logger, logger_handler, log_owner
+from inventory import load_config, read_config
 
 
-def get_default_config(cfg_fname=None):
+def get_config_fname(cfg_fname=None):
     if cfg_fname is None:
         cfg_fname = os.path.join(os.path.dirname(__file__), 'cloud.yaml')
 
         if not os.path.isfile(cfg_fname):
             cfg_fname = os.path.expanduser("~/.tcloud/cloud.yaml")
 
-    with open(cfg_fname) as fd:
-        cfg = yaml.load(fd.read())
+    return os.path.abspath(cfg_fname)
+
 
+def get_default_config(cfg_fname=None):
+    cfg_fname = get_config_fname(cfg_fname)
+
+    cfg = load_config(cfg_fname)
     cfg['cfg_folder'] = os.path.dirname(cfg_fname)
 
     return cfg
 
 
 def cloud_connect(cfg_fname=None):
+    # libvirt, guestfs, etc are imported only by commands, which need them
+    from vm import TinyCloud
+
     cloud_cfg = get_default_config(cfg_fname)
     return TinyCloud(vms=cloud_cfg['vms'],
                      templates=cloud_cfg['templates'],
                      networks=cloud_cfg['networks'],
                      urls=cloud_cfg['urls'],
-                     root=cloud_cfg['cfg_folder'])
+                     root=cloud_cfg['cfg_folder'],
+                     **cloud_cfg.get('defaults', {}))
 
 
 def create_parser():
@@ -64,12 +73,223 @@ def create_parser():
     parser.add_argument('-p', '--prepare', action="store_true", default=False)
     parser.add_argument('-l', '--loglevel', default="ERROR")
     parser.add_argument('-w', '--wait_time', default=30, type=int)
-    parser.add_argument('cmd', choices=['start', 'stop', 'list',
-                                        'login', 'vms', 'wait_ip', 'wait_ssh'])
+    parser.add_argument('-j', '--workers', default=None, type=int,
+                        help="Max amount of vm's to start concurrently")
+    parser.add_argument('-s', '--socket', default=None,
+                        help="Daemon control socket, {0} by default".format(DEFAULT_SOCKET))
+    parser.add_argument('--no-daemon', action="store_true", default=False,
+                        help="Don't pass command to running daemon")
+    parser.add_argument('-f', '--force', action="store_true", default=False,
+                        help="gc: really remove unused bases, not only list them")
+    parser.add_argument('cmd', choices=['start', 'stop', 'list', 'login',
+                                        'vms', 'xml', 'wait_ip', 'wait_ssh',
+                                        'dedup', 'gc', 'sync_net', 'daemon'])
     parser.add_argument('vmnames', nargs='*')
     return parser
 
 
+def run_cmd(cloud, opts, out=None, err=None):
+    "execute one cli command on cloud, returns exit code"
+    out = sys.stdout if out is None else out
+    err = sys.stderr if err is None else err
+
+    if opts.cmd == 'vms':
+        print >>out, "\n".join(sorted(cloud))
+    elif opts.cmd == 'start':
+        failed = False
+        for name in opts.vmnames:
+            for res in cloud.start_vm(name, opts.users, opts.prepare,
+                                      workers=opts.workers):
+                if not res.ok:
+                    print >>err, "Can't start vm", res
+                    failed = True
+        if failed:
+            return 1
+    elif opts.cmd == 'stop':
+        failed = False
+        for name in opts.vmnames:
+            for res in cloud.stop_vm(name, timeout1=opts.wait_time):
+                if not res.ok:
+                    print >>err, res
+                    failed = True
+        if failed:
+            return 1
+    elif opts.cmd == 'xml':
+        for name in opts.vmnames:
+            for vm_name, vm_xml in sorted(cloud.render_group_xml(name).items()):
+                print >>out, vm_xml
+    elif opts.cmd == 'dedup':
+        for name in opts.vmnames:
+            print >>out, "{0:<15} => {1}".format(name, cloud.dedup_images(name))
+    elif opts.cmd == 'gc':
+        # list candidates, unless removal is confirmed with --force
+        for path in cloud.gc_images(dry_run=not opts.force):
+            print >>out, "Removed" if opts.force else "Would remove", path
+    elif opts.cmd == 'sync_net':
+        failed = False
+        for name in (opts.vmnames or sorted(cloud.networks)):
+            try:
+                added, modified, removed = cloud.sync_net(name)
+            except CloudError as exc:
+                print >>err, "{0:<15} => {1}".format(name, exc)
+                failed = True
+                continue
+            templ = "{0:<15} => {1} added, {2} modified, {3} removed"
+            print >>out, templ.format(name, added, modified, removed)
+
+        if failed:
+            return 1
+    elif opts.cmd == 'login':
+        assert len(opts.vmnames) == 1
+        cloud.login_to_vm(opts.vmnames[0], opts.users)
+    elif opts.cmd == 'list':
+        for domain in cloud.list_vms():
+            try:
+                all_ips = ", ".join(cloud.get_vm_ips(domain.name()))
+            except socket.error as exc:
+                if exc.errno != errno.EPERM:
+                    raise
+                all_ips = "Not enought permissions for arp-scan"
+            print >>out, "{0:>5} {1:<15} => {2}".format(domain.ID(),
+                                                        domain.name(),
+                                                        all_ips)
+    elif opts.cmd == 'wait_ip':
+        tend = time.time() + opts.wait_time
+        for vmname in opts.vmnames:
+            while True:
+                try:
+                    ips = list(cloud.get_vm_ips(vmname))
+                except socket.error as exc:
+                    if exc.errno != errno.EPERM:
+                        raise
+                    print >>out, "Not enought permissions for arp-scan"
+                    return 1
+
+                if len(ips) != 0:
+                    print >>out, "{0:<15} => {1}".format(vmname, " ".join(ips))
+                    break
+
+                if time.time() >= tend:
+                    print >>out, "VM {0} don't get ip in time".format(vmname)
+                    return 1
+
+                time.sleep(0.01)
+
+    elif opts.cmd == 'wait_ssh':
+        failed = False
+        try:
+            for vmname, ip in cloud.wait_ssh(opts.vmnames, opts.wait_time):
+                if ip is not None:
+                    print >>out, "{0:<15} => {1}".format(vmname, ip)
+                else:
+                    templ = "VM {0} don't start ssh server in time"
+                    print >>out, templ.format(vmname)
+                    failed = True
+        except socket.error as exc:
+            if exc.errno != errno.EPERM:
+                raise
+            print >>out, "Not enought permissions for arp-scan"
+            return 1
+
+        if failed:
+            return 1
+
+    else:
+        print >>err, "Error : Unknown cmd {0}".format(opts.cmd)
+    return 0
+
+
+class DaemonCloud(object):
+    """Cloud, served by daemon
+
+    Cloud is rebuilt, when config file changes. Replaced cloud is
+    closed after last request, which uses it, finishes"""
+
+    def __init__(self, cfg_fname):
+        self.cfg_fname = cfg_fname
+        self.lock = threading.Lock()
+        self.key = None
+        self.cloud = None
+        self.refs = {}
+        # fail on daemon start, not on first request, if config is broken
+        self.release(self.acquire())
+
+    def acquire(self):
+        key = read_config(self.cfg_fname)[1]
+        with self.lock:
+            if key != self.key:
+                if self.key is not None:
+                    logger.info("Config {0} changed - reload cloud".format(self.cfg_fname))
+                old_cloud = self.cloud
+                self.cloud = cloud_connect(self.cfg_fname)
+                self.key = key
+                self.refs[self.cloud] = 0
+                if old_cloud is not None and self.refs[old_cloud] == 0:
+                    del self.refs[old_cloud]
+                    old_cloud.close()
+
+            self.refs[self.cloud] += 1
+            return self.cloud
+
+    def release(self, cloud):
+        with self.lock:
+            self.refs[cloud] -= 1
+            if cloud is not self.cloud and self.refs[cloud] == 0:
+                del self.refs[cloud]
+                cloud.close()
+
+    def close(self):
+        with self.lock:
+            clouds, self.refs, self.cloud = list(self.refs), {}, None
+        for cloud in clouds:
+            cloud.close()
+
+
+class RequestLogFilter(logging.Filter):
+    "pass only records of one request thread and its run_parallel workers"
+
+    def __init__(self, owner):
+        logging.Filter.__init__(self)
+        self.owner = owner
+
+    def filter(self, record):
+        return log_owner() is self.owner
+
+
+def daemon_request(dcloud, argv, config, out, err):
+    """run cli command inside daemon, writing its output to out and err.
+
+    returns exit code, raises Refused for commands, which cli must
+    execute itself. Log records of request, which pass its loglevel,
+    are sent to cli stderr"""
+    opts = create_parser().parse_args(argv)
+    opts.users = None
+
+    if opts.cmd in ('login', 'daemon'):
+        raise Refused("Command {0!r} can't be executed by daemon".format(opts.cmd))
+
+    if config != dcloud.cfg_fname:
+        raise Refused("Daemon serves {0}, not {1}".format(dcloud.cfg_fname, config))
+
+    handler = logging.StreamHandler(err)
+    handler.setLevel(getattr(logging, opts.loglevel))
+    handler.setFormatter(logger_handler.formatter)
+    handler.addFilter(RequestLogFilter(log_owner()))
+    logger.addHandler(handler)
+
+    try:
+        cloud = dcloud.acquire()
+        try:
+            return run_cmd(cloud, opts, out, err)
+        finally:
+            dcloud.release(cloud)
+    except CloudError as exc:
+        print >>err, exc
+        return 1
+    finally:
+        logger.removeHandler(handler)
+
+
 def main(argv=None):
     opts = create_parser().parse_args(argv)
     opts.users = None
@@ -77,83 +297,35 @@ def main(argv=None):
     logger.setLevel(getattr(logging, opts.loglevel))
     logger_handler.setLevel(getattr(logging, opts.loglevel))
 
+    sock_path = DEFAULT_SOCKET if opts.socket is None else opts.socket
+
+    if opts.cmd not in ('login', 'daemon') and not opts.no_daemon:
+        cfg_fname = get_config_fname(opts.config)
+        code = daemon_call(sock_path, sys.argv[1:] if argv is None else argv, cfg_fname)
+        if code is not None:
+            return code
+
+    if opts.cmd == 'vms':
+        # config only - don't connect to cloud
+        print "\n".join(sorted(get_default_config(opts.config)['vms']))
+        return 0
+
     try:
-        cloud = cloud_connect(opts.config)
-        if opts.cmd == 'vms':
-            print "\n".join(sorted(cloud))
-        else:
-            if opts.cmd == 'start':
-                for name in opts.vmnames:
-                    cloud.start_vm(name, opts.users, opts.prepare)
-            elif opts.cmd == 'stop':
-                for name in opts.vmnames:
-                    cloud.stop_vm(name, timeout1=opts.wait_time)
-            elif opts.cmd == 'login':
-                assert len(opts.vmnames) == 1
-                cloud.login_to_vm(opts.vmnames[0], opts.users)
-            elif opts.cmd == 'list':
-                for domain in cloud.list_vms():
-                    try:
-                        all_ips = ", ".join(cloud.get_vm_ips(domain.name()))
-                    except socket.error as err:
-                        if err.errno != errno.EPERM:
-                            raise
-                        all_ips = "Not enought permissions for arp-scan"
-                    print "{0:>5} {1:<15} => {2}".format(domain.ID(),
-                                                         domain.name(),
-                                                         all_ips)
-            elif opts.cmd == 'wait_ip':
-                tend = time.time() + opts.wait_time
-                for vmname in opts.vmnames:
-                    while True:
-                        try:
-                            ips = list(cloud.get_vm_ips(vmname))
-                        except socket.error as err:
-                            if err.errno != errno.EPERM:
-                                raise
-                            print "Not enought permissions for arp-scan"
-                            return 1
-
-                        if len(ips) != 0:
-                            print "{0:<15} => {1}".format(vmname,
-                                                          " ".join(ips))
-                            break
-
-                        if time.time() >= tend:
-                            print "VM {0} don't get ip in time".format(vmname)
-                            return 1
-
-                        time.sleep(0.01)
-
-            elif opts.cmd == 'wait_ssh':
-                tend = time.time() + opts.wait_time
-                for vmname in opts.vmnames:
-                    while True:
-                        try:
-                            ip = cloud.get_vm_ssh_ip(vmname)
-                        except socket.error as err:
-                            if err.errno != errno.EPERM:
-                                raise
-                            print "Not enought permissions for arp-scan"
-                            return 1
-
-                        if ip is not None:
-                            print "{0:<15} => {1}".format(vmname, ip)
-                            break
-
-                        if time.time() >= tend:
-                            templ = "VM {0} don't start ssh server in time"
-                            print templ.format(vmname)
-                            return 1
-
-                        time.sleep(0.01)
-
-            else:
-                print >>sys.stderr, "Error : Unknown cmd {0}".format(opts.cmd)
+        if opts.cmd == 'daemon':
+            dcloud = DaemonCloud(get_config_fname(opts.config))
+            try:
+                # records are filtered by daemon and per request handlers
+                logger.setLevel(logging.DEBUG)
+                CloudDaemon(sock_path, functools.partial(daemon_request, dcloud)).run()
+            finally:
+                dcloud.close()
+            return 0
+
+        with cloud_connect(opts.config) as cloud:
+            return run_cmd(cloud, opts)
     except CloudError as err:
         print >>sys.stderr, err
         return 1
-    return 0
 
 if __name__ == "__main__":
     exit(main(sys.argv[1:]))
@@ -21,23 +21,18 @@ from __future__ import print_function
 import termios, re, os, sys, tty
 import time, array, struct, random
 import fcntl, select, socket, logging, threading
-import subprocess, platform
+import subprocess, glob, json, errno, weakref
 
 from xml.etree.ElementTree import fromstring
 
-import paramiko
-try:
-    logging.getLogger("scapy.runtime").setLevel(logging.ERROR)
-    from scapy.all import srp, Ether, ARP, conf
-    conf.verb = 0
-except ImportError:
-    srp = None
-
-from utils import netmask2netsz
+from utils import netmask2netsz, logger, file_lock, atomic_write
+from ipam import Bitmap
+from common import CloudError
 
 logging.getLogger('ssh.transport').setLevel(logging.ERROR)
 
-arch = platform.architecture()[0]
+# platform.architecture() runs 'file' on python binary
+arch = "{0}bit".format(struct.calcsize('P') * 8)
 if arch == '32bit':
     IFNAMSIZ = 32
     ifreq_size = 32
@@ -76,8 +71,8 @@ class IfConfig(object):
     IFF_AUTOMEDIA = 0x4000      # Auto media select active.
 
     def __init__(self):
-        # create a socket so we have a handle to query
-        self.sockfd = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # socket to query is created on first use
+        self.sockfd = None
 
     def __del__(self):
         self.close()
@@ -89,6 +84,8 @@ class IfConfig(object):
             sock.close()
 
     def _fcntl(self, func, args):
+        if self.sockfd is None:
+            self.sockfd = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         return fcntl.ioctl(self.sockfd.fileno(), func, args)
 
     def _getaddr(self, ifname, func):
@@ -162,25 +159,185 @@ class IfConfig(object):
 ifconfig = IfConfig()
 
 
-class MacGenerator(object):
+class MacAllocator(object):
+    """Unique mac addresses from mac_template space
+
+    Macs, known from config and libvirt domains, and all allocated
+    ones are marked in 2 ** 24 bits bitmap (2MB, created on first use).
+    Allocated macs are stored in fname with their owners, so owner
+    gets the same mac on next run and mac stays reserved till release.
+    File is shared by processes the same way, as IPAM one"""
 
     MAX_3B_NUM = 256 ** 3
 
-    def __init__(self, mac_template='00:44:01:{0:02X}:{1:02X}:{2:02X}'):
+    def __init__(self, mac_template='00:44:01:{0:02X}:{1:02X}:{2:02X}', fname=None):
+        if fname is None:
+            fname = os.path.expanduser("~/.tcloud/macs.json")
         self.mac_template = mac_template
-        self.now = random.randint(0, self.MAX_3B_NUM - 1)
+        self.prefix = mac_template.split('{', 1)[0].upper()
+        self.fname = fname
         self.mac_lock = threading.Lock()
+        self.used = None
+        self.known = set()
+        # num => owner
+        self.allocated = {}
+        self.now = random.randint(0, self.MAX_3B_NUM - 1)
+
+    def mac2num(self, mac):
+        "number of mac in template space or None for foreign mac"
+        mac = mac.upper()
+        if not mac.startswith(self.prefix):
+            return None
+        return int(mac[len(self.prefix):].replace(':', ''), 16)
+
+    def num2mac(self, num):
+        return self.mac_template.format(num >> 16, (num >> 8) & 0xFF, num & 0xFF)
+
+    def init(self):
+        if self.used is None:
+            self.used = Bitmap(self.MAX_3B_NUM)
+
+    def read(self):
+        try:
+            with open(self.fname) as fd:
+                stored = json.load(fd)
+            if stored['template'] != self.mac_template:
+                return {}
+            return dict((int(num), owner) for num, owner in stored['macs'].items())
+        except (IOError, ValueError, KeyError, AttributeError):
+            return {}
+
+    def sync(self):
+        "apply allocations and releases, made by other processes. Call under file_lock"
+        self.init()
+        stored = self.read()
+        for num in stored:
+            if num not in self.allocated:
+                self.used.set(num)
+        for num in self.allocated:
+            if num not in stored and num not in self.known:
+                self.used.clear(num)
+        self.allocated = stored
+
+    def save(self):
+        try:
+            with atomic_write(self.fname) as fd:
+                json.dump({'template': self.mac_template, 'macs': self.allocated}, fd)
+        except (IOError, OSError) as err:
+            logger.error("Can't store mac allocations - {0}".format(err))
+
+    def add_known(self, macs):
+        "mark macs, used by someone else"
+        with self.mac_lock:
+            self.init()
+            for mac in macs:
+                num = self.mac2num(mac)
+                if num is not None:
+                    self.used.set(num)
+                    self.known.add(num)
+
+    def take_free(self, count):
+        "mark count free nums as used and returns them, call under mac_lock"
+        free = self.MAX_3B_NUM - self.used.used
+        if free < count:
+            raise CloudError("Only {0} free macs left".format(free))
+
+        nums = []
+        for _ in range(count):
+            num = self.used.find_free(self.now, self.MAX_3B_NUM)
+            if num is None:
+                num = self.used.find_free(0, self.now)
+            self.used.set(num)
+            self.now = (num + 1) % self.MAX_3B_NUM
+            nums.append(num)
+        return nums
+
+    def allocate(self, owners):
+        """returns {owner: mac} with unique stored mac for each owner - all or nothing
+
+        owner, which already has mac, gets it again"""
+        with self.mac_lock, file_lock(self.fname):
+            self.sync()
+            by_owner = dict((owner, num) for num, owner in self.allocated.items())
+            res = dict((owner, self.num2mac(by_owner[owner]))
+                       for owner in owners if owner in by_owner)
+            new_owners = [owner for owner in owners if owner not in by_owner]
+
+            for owner, num in zip(new_owners, self.take_free(len(new_owners))):
+                self.allocated[num] = owner
+                res[owner] = self.num2mac(num)
+
+            if len(new_owners) != 0:
+                self.save()
+        return res
+
+    def lookup(self, owners):
+        "returns {owner: mac} for owners, which have stored mac. Allocates nothing"
+        with self.mac_lock, file_lock(self.fname):
+            self.sync()
+            by_owner = dict((owner, num) for num, owner in self.allocated.items())
+        return dict((owner, self.num2mac(by_owner[owner]))
+                    for owner in owners if owner in by_owner)
+
+    def temporary(self, count):
+        """returns count unique macs, which aren't stored - other processes
+        may hand them out again after this one exits"""
+        with self.mac_lock, file_lock(self.fname):
+            self.sync()
+            return [self.num2mac(num) for num in self.take_free(count)]
+
+    def drop(self, nums):
+        "release nums, call under locks after sync"
+        for num in nums:
+            if num in self.allocated:
+                del self.allocated[num]
+                if num not in self.known:
+                    self.used.clear(num)
+        self.save()
+
+    def release(self, macs):
+        with self.mac_lock, file_lock(self.fname):
+            self.sync()
+            self.drop([self.mac2num(mac) for mac in macs])
+
+    def release_stale(self, is_alive, prefix=""):
+        """release macs of owners, which starts with prefix and for which
+        is_alive(owner without prefix) is False. Owners of other prefixes
+        aren't touched
+
+        returns list of released macs"""
+        with self.mac_lock, file_lock(self.fname):
+            self.sync()
+            stale = [num for num, owner in self.allocated.items()
+                     if owner.startswith(prefix) and not is_alive(owner[len(prefix):])]
+            if stale:
+                self.drop(stale)
+        return [self.num2mac(num) for num in stale]
 
     def get_next_mac(self):
+        "endless unique macs for this process only - they aren't stored"
         while True:
-            with self.mac_lock:
-                self.now = (self.now + 1) % self.MAX_3B_NUM
-                mnow = self.now
-            yield self.mac_template.format((mnow & 0xFF0000) >> 16,
-                        (mnow & 0xFF00) >> 8,
-                        mnow & 0xFF)
+            yield self.temporary(1)[0]
+
+
+# old name
+MacGenerator = MacAllocator
+
+mg = MacAllocator()
+
+
+def domain_macs(conn):
+    "macs of all active and defined domains of libvirt connection"
+    if hasattr(conn, 'listAllDomains'):
+        domains = conn.listAllDomains(0)
+    else:
+        domains = [conn.lookupByID(dom_id) for dom_id in conn.listDomainsID()]
+        domains.extend(conn.lookupByName(name) for name in conn.listDefinedDomains())
+
+    for domain in domains:
+        for mac in fromstring(domain.XMLDesc(0)).findall('devices/interface/mac'):
+            yield mac.attrib['address']
 
-mg = MacGenerator()
 
 ip_hwaddr_re = re.compile('(?P<ip>(?:\d{1,3}\.){3}\d{1,3})\s+(?P<hw>(?:[0-9A-Fa-f]{2}:){5}[0-9A-Fa-f]{2})')
 
@@ -198,35 +355,72 @@ def netscan_arpscan(dev):
             yield ip_hw_match.group('hw').upper(), ip_hw_match.group('ip')
 
 
+def parse_leases(data):
+    """Parse dnsmasq leases file or libvirt json status file
+
+    yields (hw, ip, expiry_time)"""
+    if data.lstrip().startswith('['):
+        for lease in json.loads(data):
+            yield (str(lease['mac-address']).upper(),
+                   str(lease['ip-address']),
+                   int(lease.get('expiry-time', 0)))
+    else:
+        for line in data.split('\n'):
+            params = line.split()
+            if len(params) >= 3:
+                yield params[1].upper(), params[2], int(params[0])
+
+
 def netscan_dnsmasq(lease_file=None):
     if lease_file is None:
-        lease_file = "/var/lib/misc/dnsmasq.leases"
-
-    with open(lease_file) as fd:
-        for line in fd:
-            _, mac, ip = line.split(' ', 3)[:3]
-            yield mac.upper(), ip
-
-if srp is not None:
-    def netscan_scapy(dev):
-        network = ifconfig.getAddr(dev)
-        netmask = ifconfig.getMask(dev)
-        netsize = netmask2netsz(netmask)
-
-        ans, unans = srp(
-            Ether(dst="ff:ff:ff:ff:ff:ff") / \
-                ARP(pdst="{0}/{1}".format(network, netsize)),
-                    timeout=0.1, iface=dev)
-
-        for request, responce in ans:
-            yield responce.payload.fields['hwsrc'].upper(), responce.payload.fields['psrc']
-else:
-    netscan_scapy = None
+        lease_files = leases.lease_files()
+    else:
+        lease_files = [lease_file]
+
+    for fname in lease_files:
+        with open(fname) as fd:
+            for hw, ip, _ in parse_leases(fd.read()):
+                yield hw, ip
+
+scapy_lock = threading.Lock()
+scapy_funcs = None
+
+
+def load_scapy():
+    """import scapy on first use - it takes seconds
+
+    returns (srp, Ether, ARP) or None if scapy isn't installed"""
+    global scapy_funcs
+    with scapy_lock:
+        if scapy_funcs is None:
+            try:
+                logging.getLogger("scapy.runtime").setLevel(logging.ERROR)
+                from scapy.all import srp, Ether, ARP, conf
+                conf.verb = 0
+                scapy_funcs = (srp, Ether, ARP)
+            except ImportError:
+                scapy_funcs = False
+    return scapy_funcs or None
+
+
+def netscan_scapy(dev):
+    srp, Ether, ARP = load_scapy()
+    network = ifconfig.getAddr(dev)
+    netmask = ifconfig.getMask(dev)
+    netsize = netmask2netsz(netmask)
+
+    ans, unans = srp(
+        Ether(dst="ff:ff:ff:ff:ff:ff") / \
+            ARP(pdst="{0}/{1}".format(network, netsize)),
+                timeout=0.1, iface=dev)
+
+    for request, responce in ans:
+        yield responce.payload.fields['hwsrc'].upper(), responce.payload.fields['psrc']
 
 
 def netscan(dev, method="auto", lease_file=None):
     if method == 'auto' or method == 'scapy':
-        if netscan_scapy is not None:
+        if load_scapy() is not None:
             return netscan_scapy(dev)
     if method == 'auto' or method == 'arp-scan':
         return netscan_arpscan(dev)
@@ -237,11 +431,149 @@ def netscan(dev, method="auto", lease_file=None):
     raise ValueError("Can't found appropriate method for get ip addr")
 
 
-def hw2ip(hw, dev, method="auto", lease_file=None):
-    for fhw, ip in netscan(dev, method="auto", lease_file=None):
-        if fhw.lower() == hw.lower():
-            return ip
-    raise RuntimeError("Can't found ip address for {0!r}".format(hw))
+class NeighbourTable(object):
+    """MAC => IP maps for bridges, shared by all lookups
+
+    Each map is built by one network scan and rescanned on lookup
+    only after it becomes older than ttl seconds, or on forced refresh"""
+
+    def __init__(self, ttl=1.0):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.dev_locks = {}
+        self.tables = {}
+        self.scans = 0
+
+    def get_table(self, dev, method="auto", lease_file=None, force=False):
+        key = (dev, method, lease_file)
+        with self.lock:
+            dev_lock = self.dev_locks.setdefault(key, threading.Lock())
+
+        with dev_lock:
+            scan_time, table = self.tables.get(key, (None, None))
+            if force or table is None or time.time() - scan_time >= self.ttl:
+                table = dict(netscan(dev, method=method, lease_file=lease_file))
+                self.tables[key] = (time.time(), table)
+                self.scans += 1
+            return table
+
+    def lookup(self, hw, dev, method="auto", lease_file=None, force=False):
+        table = self.get_table(dev, method, lease_file, force=force)
+        return table.get(hw.upper())
+
+    def clear(self):
+        with self.lock:
+            self.tables.clear()
+
+
+neighbours = NeighbourTable()
+
+
+class LeaseIndex(object):
+    """MAC => IP index over DHCP leases
+
+    Lease files of libvirt-managed networks are parsed once and then
+    reparsed only if their inode, size or mtime changes. Leases,
+    which aren't found in files, are requested from libvirt"""
+
+    leases_dir = '/var/lib/libvirt/dnsmasq'
+    check_interval = 0.1
+
+    def __init__(self, paths=None):
+        self.paths = paths
+        self.lock = threading.Lock()
+        self.files = {}
+        self.by_hw = {}
+        self.last_check = 0
+        self.libvirt_leases = {}
+
+    def lease_files(self):
+        if self.paths is not None:
+            return self.paths
+        return glob.glob(os.path.join(self.leases_dir, '*.status')) + \
+               glob.glob(os.path.join(self.leases_dir, '*.leases'))
+
+    def refresh(self, force=False):
+        with self.lock:
+            ctime = time.time()
+            if not force and ctime - self.last_check < self.check_interval:
+                return
+            self.last_check = ctime
+
+            changed = False
+            found = set()
+            for fname in self.lease_files():
+                try:
+                    fstat = os.stat(fname)
+                except OSError:
+                    continue
+                found.add(fname)
+
+                identity = (fstat.st_ino, fstat.st_size, fstat.st_mtime)
+                if self.files.get(fname, (None,))[0] == identity:
+                    continue
+
+                try:
+                    with open(fname) as fd:
+                        data = fd.read()
+                    file_leases = dict((hw, (ip, expiry))
+                                       for hw, ip, expiry in parse_leases(data))
+                except (IOError, ValueError, KeyError) as err:
+                    logger.debug("Can't parse lease file {0} - {1}".format(fname, err))
+                    continue
+
+                self.files[fname] = (identity, file_leases)
+                changed = True
+
+            for fname in set(self.files) - found:
+                del self.files[fname]
+                changed = True
+
+            if changed:
+                by_hw = {}
+                for _, file_leases in self.files.values():
+                    for hw, (ip, expiry) in file_leases.items():
+                        if hw not in by_hw or by_hw[hw][1] < expiry:
+                            by_hw[hw] = (ip, expiry)
+                self.by_hw = by_hw
+
+    def get_libvirt_leases(self, conn, netname):
+        key = (conn.getURI(), netname)
+        with self.lock:
+            check_time, net_leases = self.libvirt_leases.get(key, (0, {}))
+            if time.time() - check_time >= self.check_interval:
+                net_leases = {}
+                try:
+                    for lease in conn.networkLookupByName(netname).DHCPLeases():
+                        net_leases[lease['mac'].upper()] = (lease['ipaddr'],
+                                                            lease['expirytime'])
+                except Exception as err:
+                    # no DHCPLeases in libvirt before 1.2.6
+                    logger.debug("Can't get leases of {0} from libvirt - {1}".format(netname, err))
+                self.libvirt_leases[key] = (time.time(), net_leases)
+            return net_leases
+
+    def lookup(self, hw, conn=None, netname=None):
+        hw = hw.upper()
+        self.refresh()
+
+        ip, expiry = self.by_hw.get(hw, (None, 0))
+        if ip is None and conn is not None and netname is not None:
+            ip, expiry = self.get_libvirt_leases(conn, netname).get(hw, (None, 0))
+
+        if ip is not None and expiry != 0 and expiry < time.time():
+            return None
+        return ip
+
+
+leases = LeaseIndex()
+
+
+def hw2ip(hw, dev, method="auto", lease_file=None, force=False):
+    ip = neighbours.lookup(hw, dev, method, lease_file, force=force)
+    if ip is None:
+        raise RuntimeError("Can't found ip address for {0!r}".format(hw))
+    return ip
 
 
 def is_ssh_ready(ip, port=22):
@@ -258,49 +590,302 @@ def is_port_open(ip, port):
         return False
 
 
-def is_vm_online(conn, vmname):
-    for ip in get_vm_ips(conn, vmname):
-        if is_host_alive(ip, 0.1):
-            return True
-    return False
+class SSHProber(object):
+    """Non-blocking ssh readiness checker for many targets at once
+
+    Connect attempts to all ip's of all targets are in flight
+    simultaneously. Failed target is retried with exponential backoff,
+    resolve(name) is called before each attempt to get fresh ip list.
+    With check_banner target is ready only after sshd sends its banner"""
+
+    def __init__(self, resolve, port=22, check_banner=True,
+                 connect_timeout=1.0, min_backoff=0.05, max_backoff=2.0):
+        self.resolve = resolve
+        self.port = port
+        self.check_banner = check_banner
+        self.connect_timeout = connect_timeout
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+
+    def probe(self, names, timeout):
+        """yields (name, ip) as soon as name accepts ssh connections
+        and (name, None) for all names, which aren't ready in timeout"""
+        tend = time.time() + timeout
+        next_try = dict((name, 0) for name in names)
+        backoff = dict((name, self.min_backoff) for name in names)
+        # fd => [name, ip, sock, deadline, banner]
+        inflight = {}
+        poller = select.poll()
+
+        def drop(fd):
+            name, _, sock, _, _ = inflight.pop(fd)
+            poller.unregister(fd)
+            sock.close()
+            return name
 
+        def failed(fd):
+            name = drop(fd)
+            if name in next_try and not any(val[0] == name for val in inflight.values()):
+                next_try[name] = time.time() + backoff[name]
+                backoff[name] = min(backoff[name] * 2, self.max_backoff)
 
-def get_network_bridge(conn, netname, br_map={}, clear=False):
-    netid = (conn.getURI(), netname)
-    if clear:
-        br_map.clear()
+        try:
+            while next_try:
+                ctime = time.time()
+                if ctime >= tend:
+                    break
 
-    try:
-        return br_map[netid]
-    except KeyError:
-        net = conn.networkLookupByName(netname)
-        xml = fromstring(net.XMLDesc(0))
-        br_name = xml.find('bridge').attrib['name']
-        br_map[netid] = br_name
-        return br_name
+                for name, try_time in next_try.items():
+                    if try_time is None or try_time > ctime:
+                        continue
+
+                    next_try[name] = None
+                    for ip in self.resolve(name):
+                        sock = socket.socket()
+                        sock.setblocking(0)
+                        err = sock.connect_ex((ip, self.port))
+                        if err not in (0, errno.EINPROGRESS):
+                            sock.close()
+                            continue
+                        inflight[sock.fileno()] = [name, ip, sock,
+                                                   ctime + self.connect_timeout, None]
+                        poller.register(sock, select.POLLOUT)
+
+                    if next_try[name] is None and not any(val[0] == name
+                                                          for val in inflight.values()):
+                        next_try[name] = ctime + backoff[name]
+                        backoff[name] = min(backoff[name] * 2, self.max_backoff)
+
+                wake_at = [tend]
+                wake_at.extend(try_time for try_time in next_try.values()
+                               if try_time is not None)
+                wake_at.extend(val[3] for val in inflight.values())
+                wait_for = max(0, min(wake_at) - time.time())
+
+                for fd, event in poller.poll(wait_for * 1000):
+                    if fd not in inflight:
+                        # dropped, because other ip of same name became ready
+                        continue
+                    name, ip, sock, _, banner = inflight[fd]
+
+                    if banner is None:
+                        if event & (select.POLLERR | select.POLLHUP) or \
+                                sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+                            failed(fd)
+                            continue
+
+                        if self.check_banner:
+                            inflight[fd][4] = ""
+                            poller.modify(sock, select.POLLIN)
+                            continue
+                    else:
+                        try:
+                            data = sock.recv(256)
+                        except socket.error:
+                            data = ""
+
+                        banner += data
+                        inflight[fd][4] = banner
+                        if data == "" or not "SSH-".startswith(banner[:4]):
+                            failed(fd)
+                            continue
+                        if len(banner) < 4:
+                            continue
+
+                    del next_try[name]
+                    for other_fd, val in inflight.items():
+                        if val[0] == name:
+                            drop(other_fd)
+                    yield name, ip
+
+                ctime = time.time()
+                for fd, val in inflight.items():
+                    if val[3] <= ctime:
+                        failed(fd)
+        finally:
+            for fd in inflight.keys():
+                drop(fd)
+
+        for name in names:
+            if name in next_try:
+                yield name, None
 
 
-def get_vm_ips(conn, vmname):
-    vm = conn.lookupByName(vmname)
-    xml = vm.XMLDesc(0)
-    xml_desc = fromstring(xml)
+def is_vm_online(conn, vmname):
+    ips = list(get_vm_ips(conn, vmname))
+    if ips == []:
+        return False
+    return any(delay is not None for delay in ping_many(ips, 0.1).values())
 
-    for xml_iface in xml_desc.findall("devices/interface"):
-        netname = xml_iface.find('source').attrib['network']
-        lookup_hwaddr = xml_iface.find('mac').attrib['address']
-        br_name = get_network_bridge(conn, netname)
 
-        try:
-            yield hw2ip(lookup_hwaddr, br_name)
-        except RuntimeError:
-            pass
+class DomainMetaCache(object):
+    """Interfaces of domains and bridges of networks
 
+    Entries are keyed by connection uri and domain/network uuid and
+    live till libvirt reports lifecycle (or device) event for them.
+    Connections, which can't deliver events, get entries with short ttl.
 
-def get_vm_ssh_ip(conn, vmname):
-    for ip in get_vm_ips(conn, vmname):
-        if is_ssh_ready(ip):
-            return ip
-    return None
+    Events bump generation of name (and of whole uri on reconnect),
+    so xml, fetched before event, isn't stored after it"""
+
+    unwatched_ttl = 1.0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # uri => weakref to connection with registered callbacks or None
+        self.watched = {}
+        # uri => generation, bumped when all entries of uri are dropped
+        self.epochs = {}
+        # (uri, name) => generation, bumped by events
+        self.domain_gens = {}
+        self.net_gens = {}
+        # (uri, name) => uuid
+        self.domain_uuids = {}
+        self.net_uuids = {}
+        # (uri, uuid) => (expire time, value)
+        self.domains = {}
+        self.bridges = {}
+
+    def watch(self, conn, uri):
+        "subscribe to events of conn once, returns True if events are delivered"
+        with self.lock:
+            if uri in self.watched:
+                conn_ref = self.watched[uri]
+                if conn_ref is None:
+                    return False
+                if conn_ref() is conn:
+                    return True
+
+            # new or reopened connection - events might be lost in between
+            self.drop_uri(uri)
+            self.watched[uri] = None
+
+        import libvirt
+
+        watching = False
+        try:
+            conn.domainEventRegisterAny(None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                                        self.on_domain_event, uri)
+            watching = True
+            for ev_name in ('VIR_DOMAIN_EVENT_ID_DEVICE_ADDED', 'VIR_DOMAIN_EVENT_ID_DEVICE_REMOVED'):
+                if hasattr(libvirt, ev_name):
+                    conn.domainEventRegisterAny(None, getattr(libvirt, ev_name),
+                                                self.on_domain_event, uri)
+        except Exception as err:
+            logger.debug("Can't subscribe to domain events of {0} - {1}".format(uri, err))
+
+        if watching:
+            try:
+                conn.networkEventRegisterAny(None, libvirt.VIR_NETWORK_EVENT_ID_LIFECYCLE,
+                                             self.on_network_event, uri)
+            except Exception as err:
+                # no network events in libvirt before 1.2.1
+                logger.debug("Can't subscribe to network events of {0} - {1}".format(uri, err))
+                watching = False
+
+        if watching:
+            with self.lock:
+                # closed connections must not be kept alive by cache
+                self.watched[uri] = weakref.ref(conn)
+        return watching
+
+    def drop_uri(self, uri):
+        "call under lock"
+        self.epochs[uri] = self.epochs.get(uri, 0) + 1
+        for cache in (self.domain_uuids, self.net_uuids, self.domains, self.bridges,
+                      self.domain_gens, self.net_gens):
+            for key in [key for key in cache if key[0] == uri]:
+                del cache[key]
+
+    def invalidate(self, uri, obj, uuids, cache, gens):
+        key = (uri, obj.name())
+        with self.lock:
+            gens[key] = gens.get(key, 0) + 1
+            uuids.pop(key, None)
+            cache.pop((uri, obj.UUIDString()), None)
+
+    def on_domain_event(self, conn, dom, *args):
+        self.invalidate(args[-1], dom, self.domain_uuids, self.domains, self.domain_gens)
+
+    def on_network_event(self, conn, net, event, detail, uri):
+        self.invalidate(uri, net, self.net_uuids, self.bridges, self.net_gens)
+
+    def cached(self, conn, name, uuids, cache, gens, lookup, parse):
+        uri = conn.getURI()
+        ttl = None if self.watch(conn, uri) else self.unwatched_ttl
+        ctime = time.time()
+
+        with self.lock:
+            uuid = uuids.get((uri, name))
+            expire, value = cache.get((uri, uuid), (0, None))
+            if uuid is not None and (expire is None or expire > ctime):
+                return value
+            generation = (self.epochs.get(uri), gens.get((uri, name)))
+
+        obj = lookup(name)
+        uuid = obj.UUIDString()
+        value = parse(fromstring(obj.XMLDesc(0)))
+        with self.lock:
+            if generation == (self.epochs.get(uri), gens.get((uri, name))):
+                uuids[(uri, name)] = uuid
+                cache[(uri, uuid)] = (None if ttl is None else ctime + ttl, value)
+        return value
+
+    def interfaces(self, conn, vmname):
+        "list of (mac, network name) of domain interfaces"
+        return self.cached(conn, vmname, self.domain_uuids, self.domains, self.domain_gens,
+                           conn.lookupByName, parse_domain_interfaces)
+
+    def bridge(self, conn, netname):
+        return self.cached(conn, netname, self.net_uuids, self.bridges, self.net_gens,
+                           conn.networkLookupByName,
+                           lambda xml: xml.find('bridge').attrib['name'])
+
+
+def parse_domain_interfaces(xml):
+    res = []
+    for xml_iface in xml.findall("devices/interface"):
+        source = xml_iface.find('source')
+        if source is not None and 'network' in source.attrib:
+            res.append((xml_iface.find('mac').attrib['address'], source.attrib['network']))
+    return res
+
+
+domain_meta = DomainMetaCache()
+
+
+def get_network_bridge(conn, netname):
+    return domain_meta.bridge(conn, netname)
+
+
+def get_vm_ips(conn, vmname, method="auto"):
+    """yields ip addresses of vm interfaces
+
+    method 'leases' uses only DHCP leases, 'auto' - leases and
+    network scan for interfaces without lease, others are passed to netscan"""
+    for lookup_hwaddr, netname in domain_meta.interfaces(conn, vmname):
+        ip = None
+        if method in ('auto', 'leases'):
+            ip = leases.lookup(lookup_hwaddr, conn, netname)
+
+        if ip is None and method != 'leases':
+            br_name = get_network_bridge(conn, netname)
+            try:
+                ip = hw2ip(lookup_hwaddr, br_name, method=method)
+            except RuntimeError:
+                pass
+
+        if ip is not None:
+            yield ip
+
+
+def get_vm_ssh_ip(conn, vmname, method="auto", timeout=0.1):
+    "returns first ip of vm, which accepts ssh connections, or None"
+    ips = list(get_vm_ips(conn, vmname, method))
+    prober = SSHProber(lambda name: ips, check_banner=False,
+                       connect_timeout=timeout, max_backoff=timeout)
+    for _, ip in prober.probe([vmname], timeout):
+        return ip
 
 
 def get_myaddress(iface="eth0"):
@@ -309,99 +894,48 @@ def get_myaddress(iface="eth0"):
 
 
 ICMP_ECHO_REQUEST = 8
+ICMP_ECHO_REPLY = 0
+ICMP_HEADER = "bbHHH"
 
 
 def checksum(source_string):
     """
-    I'm not too confident that this is right but testing seems
-    to suggest that it gives the same answers as in_cksum in ping.c
+    Internet checksum of source_string, byte-swapped the same way as
+    in_cksum in ping.c does it. Caller should apply htons to result
     """
-    csum = 0
-    countTo = (len(source_string) / 2) * 2
-    count = 0
-    while count < countTo:
-        thisVal = ord(source_string[count + 1]) * 256 + ord(source_string[count])
-        csum = csum + thisVal
-        csum = csum & 0xffffffff
-        count = count + 2
-
-    if countTo < len(source_string):
-        csum = csum + ord(source_string[len(source_string) - 1])
-        csum = csum & 0xffffffff
+    if len(source_string) % 2 != 0:
+        source_string += '\0'
 
+    csum = sum(struct.unpack("<{0}H".format(len(source_string) // 2), source_string))
     csum = (csum >> 16) + (csum & 0xffff)
     csum = csum + (csum >> 16)
-    answer = ~csum
-    answer = answer & 0xffff
-
-    # Swap bytes. Bugger me if I know why.
-    answer = answer >> 8 | (answer << 8 & 0xff00)
+    answer = ~csum & 0xffff
 
-    return answer
+    return answer >> 8 | (answer << 8 & 0xff00)
 
 
-def receive_one_ping(my_socket, ID, timeout):
-    """
-    receive the ping from the socket.
-    """
-    timeLeft = timeout
-    while True:
-        startedSelect = time.time()
-        whatReady = select.select([my_socket], [], [], timeLeft)
-        howLongInSelect = (time.time() - startedSelect)
-        if whatReady[0] == []:
-            return
-
-        timeReceived = time.time()
-        recPacket, addr = my_socket.recvfrom(1024)
-        icmpHeader = recPacket[20:28]
-        type, code, checksum, packetID, sequence = struct.unpack(
-            "bbHHh", icmpHeader
-        )
-        if packetID == ID:
-            bytesInDouble = struct.calcsize("d")
-            timeSent = struct.unpack("d", recPacket[28:28 + bytesInDouble])[0]
-            return timeReceived - timeSent
-
-        timeLeft = timeLeft - howLongInSelect
-        if timeLeft <= 0:
-            return
-
-
-def send_one_ping(my_socket, dest_addr, ID):
+def send_one_ping(my_socket, dest_addr, ID, seq=1):
     """
     Send one ping to the given >dest_addr<.
     """
-    dest_addr = socket.gethostbyname(dest_addr)
-
     # Header is type (8), code (8), checksum (16), id (16), sequence (16)
-    my_checksum = 0
-
     # Make a dummy heder with a 0 checksum.
-    header = struct.pack("bbHHh", ICMP_ECHO_REQUEST, 0, my_checksum, ID, 1)
+    header = struct.pack(ICMP_HEADER, ICMP_ECHO_REQUEST, 0, 0, ID, seq)
     bytesInDouble = struct.calcsize("d")
     data = (192 - bytesInDouble) * "Q"
     data = struct.pack("d", time.time()) + data
 
-    # Calculate the checksum on the data and the dummy header.
-    my_checksum = checksum(header + data)
-
     # Now that we have the right checksum, we put that in. It's just easier
     # to make up a new header than to stuff it into the dummy.
-    header = struct.pack(
-        "bbHHh", ICMP_ECHO_REQUEST, 0, socket.htons(my_checksum), ID, 1
-    )
-    packet = header + data
-    my_socket.sendto(packet, (dest_addr, 1))
+    header = struct.pack(ICMP_HEADER, ICMP_ECHO_REQUEST, 0,
+                         socket.htons(checksum(header + data)), ID, seq)
+    my_socket.sendto(header + data, (dest_addr, 1))
 
 
-def ping(dest_addr, timeout=1):
-    """
-    Returns either the delay (in seconds) or none on timeout.
-    """
+def icmp_socket():
     icmp = socket.getprotobyname("icmp")
     try:
-        my_socket = socket.socket(socket.AF_INET, socket.SOCK_RAW, icmp)
+        return socket.socket(socket.AF_INET, socket.SOCK_RAW, icmp)
     except socket.error, (errno, msg):
         if errno == 1:
             # Operation not permitted
@@ -412,13 +946,63 @@ def ping(dest_addr, timeout=1):
             raise socket.error(msg)
         raise
 
+
+def ping_many(dest_addrs, timeout=1):
+    """
+    Ping all dest_addrs from one raw socket and collect replies during
+    one timeout window. Returns {addr: delay in seconds or None}
+    """
+    my_socket = icmp_socket()
     my_ID = os.getpid() & 0xFFFF
+    delays = dict((addr, None) for addr in dest_addrs)
+
+    try:
+        # room for replies from big networks
+        my_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+
+        by_seq = {}
+        for seq, addr in enumerate(delays):
+            seq = seq & 0xFFFF
+            by_seq[seq] = (addr, socket.gethostbyname(addr))
+            send_one_ping(my_socket, by_seq[seq][1], my_ID, seq)
+
+        tend = time.time() + timeout
+        wait_for = len(by_seq)
+
+        while wait_for > 0:
+            timeLeft = tend - time.time()
+            if timeLeft <= 0 or select.select([my_socket], [], [], timeLeft)[0] == []:
+                break
+
+            timeReceived = time.time()
+            recPacket, (src_addr, _) = my_socket.recvfrom(1024)
+            icmp_offset = (ord(recPacket[0]) & 0x0F) * 4
+            icmp_type, _, _, packetID, seq = struct.unpack(
+                ICMP_HEADER, recPacket[icmp_offset:icmp_offset + 8]
+            )
+
+            # own echo requests to local addresses are received too
+            if icmp_type != ICMP_ECHO_REPLY or packetID != my_ID or seq not in by_seq:
+                continue
+
+            addr, ip = by_seq[seq]
+            if ip != src_addr or delays[addr] is not None:
+                continue
+
+            timeSent = struct.unpack("d", recPacket[icmp_offset + 8:icmp_offset + 16])[0]
+            delays[addr] = timeReceived - timeSent
+            wait_for -= 1
+    finally:
+        my_socket.close()
 
-    send_one_ping(my_socket, dest_addr, my_ID)
-    delay = receive_one_ping(my_socket, my_ID, timeout)
+    return delays
 
-    my_socket.close()
-    return delay
+
+def ping(dest_addr, timeout=1):
+    """
+    Returns either the delay (in seconds) or none on timeout.
+    """
+    return ping_many([dest_addr], timeout)[dest_addr]
 
 
 def is_host_alive(ip, timeout=1, method='internal'):
@@ -464,6 +1048,8 @@ def posix_shell(chan):
 
 
 def login_ssh_paramiko(ip, user, passwd, port=22, timeout=1):
+    import paramiko
+
     ssh = paramiko.SSHClient()
     ssh.load_system_host_keys()
     ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
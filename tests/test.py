@@ -17,10 +17,21 @@
 # 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA.
 
 import re
+import os
+import socket
+import shutil
+import tempfile
 import subprocess
 
 from tiny_cloud.utils import parse_credentials, int2ip, ip2int, netmask2netsz, netsz2netmask
-from tiny_cloud.network import ifconfig, ping, is_host_alive
+from tiny_cloud.network import ifconfig, ping, ping_many, is_host_alive, parse_leases, checksum, \
+                               SSHProber, MacAllocator
+from tiny_cloud.disk_image import PrepareFingerprint, PREPARE_SECTIONS, copy_image, \
+                                  LocalGuestFS, GuestEditPlan
+from tiny_cloud import inventory
+from tiny_cloud.inventory import VM, Inventory, Network, load_config
+from tiny_cloud.ipam import IPAM, IPPool, IPConflict
+from tiny_cloud.common import CloudError
 from oktest import ok
 
 
@@ -94,3 +105,364 @@ def test_ping():
         ip = ifconfig.getAddr(iname)
         ok(ping(ip, 0.1)) <= 0.1
         ok(is_host_alive(ip, 0.1)) == True
+
+
+def test_ping_many():
+    ok(checksum('\x00\x01\xf2\x03\xf4\xf5\xf6\xf7')) == 0x220D
+    ok(checksum('abc')) == 15261
+
+    ips = [ifconfig.getAddr(iname) for iname in ifconfig.getInterfaceList()]
+    delays = ping_many(ips, 0.1)
+    ok(sorted(delays)) == sorted(set(ips))
+    for ip in ips:
+        ok(delays[ip]) <= 0.1
+
+
+def test_ssh_prober():
+    srv = socket.socket()
+    srv.bind(('127.0.0.1', 0))
+    srv.listen(5)
+    try:
+        # all connections to same listener become ready in one poll
+        prober = SSHProber(lambda name: ['127.0.0.1'] * 3, port=srv.getsockname()[1],
+                           check_banner=False)
+        ok(list(prober.probe(['vm'], 1))) == [('vm', '127.0.0.1')]
+    finally:
+        srv.close()
+
+
+def test_parse_leases():
+    dnsmasq_leases = "1356000000 52:54:00:98:7f:ef 192.168.152.37 ceph-1 *\n"
+    ok(list(parse_leases(dnsmasq_leases))) == \
+                [('52:54:00:98:7F:EF', '192.168.152.37', 1356000000)]
+
+    libvirt_status = '''[{"ip-address": "192.168.152.38",
+                          "mac-address": "52:54:00:98:7f:f0",
+                          "expiry-time": 1356000000}]'''
+    ok(list(parse_leases(libvirt_status))) == \
+                [('52:54:00:98:7F:F0', '192.168.152.38', 1356000000)]
+    ok(list(parse_leases(""))) == []
+
+
+def test_prepare_fingerprint():
+    fd, image = tempfile.mkstemp()
+    os.close(fd)
+    eth_devs = {'eth0': ('52:54:00:98:7F:EF', 'dhcp', None, None)}
+    try:
+        fprint = PrepareFingerprint(image, 'ceph-1', {'ubuntu': 'ubuntu'}, eth_devs)
+        ok(fprint.changed_sections()) == PREPARE_SECTIONS
+        fprint.save()
+        ok('ubuntu' in open(image + '.tcloud.json').read()) == False
+
+        fprint = PrepareFingerprint(image, 'ceph-1', {'ubuntu': 'ubuntu'}, eth_devs)
+        ok(fprint.changed_sections()) == ()
+
+        fprint = PrepareFingerprint(image, 'ceph-2', {'ubuntu': 'ubuntu'}, eth_devs)
+        ok(fprint.changed_sections()) == ('hostname',)
+    finally:
+        for fname in (image, image + '.tcloud.json'):
+            if os.path.exists(fname):
+                os.unlink(fname)
+
+
+def test_copy_image():
+    src_dir = tempfile.mkdtemp()
+    src = os.path.join(src_dir, 'src.img')
+    dst = os.path.join(src_dir, 'dst.img')
+    size = 100 * 1024 ** 2 + 4096
+    try:
+        with open(src, 'wb') as fd:
+            fd.write('a' * 4096)
+            fd.seek(100 * 1024 ** 2)
+            fd.write('b' * 4096)
+
+        calls = []
+        copy_image(src, dst, progress=lambda *args: calls.append(args))
+
+        with open(src, 'rb') as fd1, open(dst, 'rb') as fd2:
+            ok(fd2.read()) == fd1.read()
+        ok(os.stat(dst).st_size) == size
+        # only data areas are allocated
+        ok(os.stat(dst).st_blocks * 512 < 1024 ** 2) == True
+        ok(calls[-1][:2]) == (size, size)
+    finally:
+        for fname in (src, dst):
+            if os.path.exists(fname):
+                os.unlink(fname)
+        os.rmdir(src_dir)
+
+
+class CountingGuestFS(LocalGuestFS):
+    "LocalGuestFS, which counts reads of each file"
+
+    def __init__(self, root):
+        LocalGuestFS.__init__(self, root)
+        self.reads = {}
+
+    def read_file(self, fname):
+        self.reads[fname] = self.reads.get(fname, 0) + 1
+        return LocalGuestFS.read_file(self, fname)
+
+
+def test_guest_edit_plan():
+    root = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(root, 'etc'))
+        for name, data, mode in (('shadow', 'root:x:', 0o600),
+                                 ('hostname', 'old', 0o644),
+                                 ('motd', 'bye', 0o644)):
+            fname = os.path.join(root, 'etc', name)
+            with open(fname, 'w') as fd:
+                fd.write(data)
+            os.chmod(fname, mode)
+
+        gfs = CountingGuestFS(root)
+        plan = GuestEditPlan(gfs)
+        plan.write('/etc/shadow', plan.read_file('/etc/shadow') + 'new')
+        ok(plan.read_file('/etc/shadow')) == 'root:x:new'
+        plan.write('/etc/hostname', plan.read_file('/etc/hostname').replace('old', 'new'))
+        ok(plan.read_file('/etc/hostname')) == 'new'
+        plan.mkdir_p('/etc/ssh')
+        plan.write('/etc/ssh/sshd_config', 'PasswordAuthentication yes')
+        plan.rm('/etc/motd')
+
+        # nothing is changed before commit
+        ok(open(os.path.join(root, 'etc/shadow')).read()) == 'root:x:'
+        plan.commit()
+
+        ok(gfs.reads) == {'/etc/shadow': 1, '/etc/hostname': 1}
+        ok(open(os.path.join(root, 'etc/shadow')).read()) == 'root:x:new'
+        ok(open(os.path.join(root, 'etc/hostname')).read()) == 'new'
+        ok(open(os.path.join(root, 'etc/ssh/sshd_config')).read()) == 'PasswordAuthentication yes'
+        ok(os.stat(os.path.join(root, 'etc/shadow')).st_mode & 0o7777) == 0o600
+        ok(os.stat(os.path.join(root, 'etc/hostname')).st_mode & 0o7777) == 0o644
+        ok(sorted(os.listdir(os.path.join(root, 'etc')))) == ['hostname', 'shadow', 'ssh']
+    finally:
+        shutil.rmtree(root)
+
+
+def test_inventory():
+    vm = VM('lab.ceph.ceph-1', images=['ceph_1.img'], opts='virtio',
+            eth0='52:54:00:98:7F:EF, ceph', eth1='AA:54:00:98:7F:F0, 10.0.0.2')
+    ok([(nic.name, nic.mac, nic.ip, nic.network) for nic in vm.nics]) == \
+                [('eth0', '52:54:00:98:7F:EF', None, 'ceph'),
+                 ('eth1', 'AA:54:00:98:7F:F0', '10.0.0.2', 'default')]
+
+    inv = Inventory({vm.name: vm,
+                     'lab.ceph-client': VM('lab.ceph-client', image='client.img'),
+                     'lab2': VM('lab2', image='lab2.img')})
+    ok(sorted(v.name for v in inv.find('lab'))) == ['lab.ceph-client', 'lab.ceph.ceph-1']
+    ok([v.name for v in inv.find('lab.ceph')]) == ['lab.ceph.ceph-1']
+    ok([v.name for v in inv.find('lab2')]) == ['lab2']
+    ok(inv.find('la')) == []
+    ok(inv.by_mac['AA:54:00:98:7F:F0'][0].name) == 'lab.ceph.ceph-1'
+    ok([v.name for v in inv.by_network['ceph']]) == ['lab.ceph.ceph-1']
+
+    inv.remove(vm.name)
+    ok(inv.find('lab.ceph')) == []
+    ok('52:54:00:98:7F:EF' in inv.by_mac) == False
+
+
+def test_load_config():
+    tmp_dir = tempfile.mkdtemp()
+    cfg_fname = os.path.join(tmp_dir, 'cloud.yaml')
+    cache_dir = os.path.join(tmp_dir, 'cache')
+    text = "vms:\n    {0}:\n        image: a.img\nnetworks: {{}}\n"
+    compile_config = inventory.compile_config
+    try:
+        with open(cfg_fname, 'w') as fd:
+            fd.write(text.format('a'))
+        ok(load_config(cfg_fname, cache_dir)['vms'].keys()) == ['a']
+        cache_files = os.listdir(cache_dir)
+        ok(len(cache_files)) == 1
+
+        def no_compile(data):
+            raise AssertionError("config compiled on cache hit")
+        inventory.compile_config = no_compile
+        ok(load_config(cfg_fname, cache_dir)['vms'].keys()) == ['a']
+        inventory.compile_config = compile_config
+
+        # edit invalidates cache
+        with open(cfg_fname, 'w') as fd:
+            fd.write(text.format('bb'))
+        ok(load_config(cfg_fname, cache_dir)['vms'].keys()) == ['bb']
+
+        # broken cache is recompiled and rewritten
+        with open(os.path.join(cache_dir, cache_files[0]), 'wb') as fd:
+            fd.write('broken pickle')
+        ok(load_config(cfg_fname, cache_dir)['vms'].keys()) == ['bb']
+        inventory.compile_config = no_compile
+        ok(load_config(cfg_fname, cache_dir)['vms'].keys()) == ['bb']
+    finally:
+        inventory.compile_config = compile_config
+        shutil.rmtree(tmp_dir)
+
+
+class StubNetwork(object):
+    "libvirt network with dhcp hosts, networkUpdate calls are recorded"
+
+    def __init__(self, hosts):
+        self.hosts = hosts
+        self.updates = []
+
+    def XMLDesc(self, flags):
+        hosts = "".join('<host mac="{0}" name="{1}" ip="{2}"/>'.format(mac, name, ip)
+                        for mac, (name, ip) in sorted(self.hosts.items()))
+        return "<network><ip><dhcp>{0}</dhcp></ip></network>".format(hosts)
+
+    def isActive(self):
+        return True
+
+    def isPersistent(self):
+        return False
+
+    def update(self, command, section, index, xml, flags):
+        self.updates.append((command, xml))
+
+
+def test_update_net_hosts():
+    import libvirt
+    from tiny_cloud.vm import TinyCloud
+
+    vms = {'g': {'type': 'network',
+                 'a': {'image': 'a.img', 'eth0': '52:54:00:00:00:01, 10.0.0.10, ceph'},
+                 'b': {'image': 'b.img', 'eth0': '52:54:00:00:00:02, 10.0.0.11, ceph'}}}
+    cloud = TinyCloud(vms, {}, {}, {'kvm': 'qemu:///system'}, tempfile.gettempdir())
+
+    net = StubNetwork({'52:54:00:00:00:01': ('g-a', '10.0.0.20'),
+                       # foreign host
+                       '52:54:00:00:00:03': ('other', '10.0.0.50'),
+                       # foreign host with address of g.b
+                       '52:54:00:00:00:04': ('old', '10.0.0.11')})
+    ok(cloud.update_net_hosts(net, 'ceph')) == (1, 1, 1)
+    commands = [command for command, _ in net.updates]
+    ok(commands) == [libvirt.VIR_NETWORK_UPDATE_COMMAND_DELETE,
+                     libvirt.VIR_NETWORK_UPDATE_COMMAND_MODIFY,
+                     libvirt.VIR_NETWORK_UPDATE_COMMAND_ADD_LAST]
+    ok('52:54:00:00:00:04' in net.updates[0][1]) == True
+    ok('10.0.0.10' in net.updates[1][1]) == True
+    ok('52:54:00:00:00:02' in net.updates[2][1]) == True
+
+    # nothing to do for synced network
+    net = StubNetwork({'52:54:00:00:00:01': ('g-a', '10.0.0.10'),
+                       '52:54:00:00:00:02': ('g-b', '10.0.0.11'),
+                       '52:54:00:00:00:03': ('other', '10.0.0.50')})
+    ok(cloud.update_net_hosts(net, 'ceph')) == (0, 0, 0)
+    ok(net.updates) == []
+
+    # foreign host has name of inventory one - nothing is changed
+    net = StubNetwork({'52:54:00:00:00:05': ('g-a', '10.0.0.60')})
+    try:
+        cloud.update_net_hosts(net, 'ceph')
+        ok(True) == False
+    except CloudError:
+        pass
+    ok(net.updates) == []
+
+
+def test_ipam():
+    pool = IPPool('10.0.0.2', '10.0.0.5', 24)
+    ok(pool.allocate('a')) == '10.0.0.2'
+    pool.reserve('10.0.0.3', 'b')
+    ok(pool.allocate('c')) == '10.0.0.4'
+    ok(pool.allocate_many(['d'])) == {'d': '10.0.0.5'}
+    ok(pool.free) == 0
+
+    pool.release('10.0.0.3')
+    ok(pool.allocate('e')) == '10.0.0.3'
+    try:
+        pool.allocate_many(['f', 'g'])
+        ok(True) == False
+    except CloudError:
+        pass
+
+    try:
+        pool.reserve('10.0.0.2', 'h')
+        ok(True) == False
+    except IPConflict:
+        pass
+
+    fd, fname = tempfile.mkstemp()
+    os.close(fd)
+    os.unlink(fname)
+    try:
+        net = Network('ceph', range='192.168.152.2 - 192.168.152.254 / 24', bridge='virbr2')
+        ipam = IPAM(fname)
+        ipam.add_network(net)
+        ips = ipam.allocate('ceph', ['vm{0}'.format(i) for i in range(200)])
+        ok(len(set(ips.values()))) == 200
+        ok('192.168.152.3' in ips.values()) == False  # bridge address
+
+        ipam = IPAM(fname)
+        ipam.add_network(net)
+        inv = Inventory({'vm': VM('vm', image='vm.img', eth0='52:54:00:98:7F:EF, {0}, ceph'
+                                                             .format(ips['vm7']))})
+        ok(ipam.reserve_static(inv)) == \
+            [('vm', "Address {0} of vm:eth0 is already used by vm7".format(ips['vm7']))]
+
+        # other process allocates and releases in the same file
+        other = IPAM(fname)
+        other.add_network(net)
+        other.release('ceph', [ips['vm0']])
+        ip1 = other.allocate('ceph', ['x'])['x']
+        ip2 = ipam.allocate('ceph', ['y'])['y']
+        ok(ip1) != ip2
+        ok(ipam.get_pool('ceph').owner(ip1)) == 'x'
+
+        # owner gets its address again, stale owners of prefix are released
+        ok(ipam.allocate('ceph', ['x', 'y'])) == {'x': ip1, 'y': ip2}
+        ok(ipam.release_stale(lambda owner: owner != '1', prefix='vm')) == [ips['vm1']]
+        ok(other.allocate('ceph', ['x'])) == {'x': ip1}
+        ok(other.get_pool('ceph').owner(ips['vm1'])) == None
+    finally:
+        for path in (fname, fname + '.lock'):
+            if os.path.exists(path):
+                os.unlink(path)
+
+
+def test_mac_allocator():
+    fd, fname = tempfile.mkstemp()
+    os.close(fd)
+    os.unlink(fname)
+
+    def allocator():
+        # 4 macs space
+        macs = MacAllocator(fname=fname)
+        macs.MAX_3B_NUM = 4
+        macs.now = 0
+        return macs
+
+    try:
+        macs = allocator()
+        macs.add_known(['00:44:01:00:00:00', '52:54:00:98:7F:EF'])
+        res = macs.allocate(['a:eth0', 'b:eth0'])
+        ok(res) == {'a:eth0': '00:44:01:00:00:01', 'b:eth0': '00:44:01:00:00:02'}
+        ok(macs.allocate(['a:eth0'])) == {'a:eth0': '00:44:01:00:00:01'}
+
+        try:
+            macs.allocate(['c:eth0', 'd:eth0'])
+            ok(True) == False
+        except CloudError:
+            pass
+
+        # other process sees stored allocations
+        other = allocator()
+        ok(other.allocate(['b:eth0', 'c:eth0'])) == \
+                    {'b:eth0': '00:44:01:00:00:02', 'c:eth0': '00:44:01:00:00:00'}
+        ok(other.release_stale(lambda owner: owner != 'a:eth0')) == ['00:44:01:00:00:01']
+        # owners of other config aren't touched
+        ok(other.release_stale(lambda owner: False, prefix='/other/cfg:')) == []
+        ok(other.lookup(['b:eth0', 'z:eth0'])) == {'b:eth0': '00:44:01:00:00:02'}
+        ok(other.temporary(1)) == ['00:44:01:00:00:01']
+
+        ok(macs.allocate(['d:eth0'])) == {'d:eth0': '00:44:01:00:00:03'}
+        ok(macs.allocate(['e:eth0'])) == {'e:eth0': '00:44:01:00:00:01'}
+        try:
+            macs.allocate(['f:eth0'])
+            ok(True) == False
+        except CloudError:
+            pass
+    finally:
+        for path in (fname, fname + '.lock'):
+            if os.path.exists(path):
+                os.unlink(path)
@@ -1,5 +1,15 @@
+import os
 import re
+import time
+import fcntl
+import Queue
+import socket
+import struct
 import logging
+import threading
+import contextlib
+
+from common import TaskResult
 
 
 cred_rr = r"(?P<login>.*?):(?P<passwd>.*)@(?P<host>[^+]*)(?P<port>\+\d+)?"
@@ -31,26 +41,115 @@ def parse_credentials(credentials):
 
 
 def ip2int(ip):
-    it = zip(map(int, ip.split('.')),
-             (256 ** x for x in range(4)[::-1]))
-    return sum(x * y for x, y in it)
+    return struct.unpack("!I", socket.inet_aton(ip))[0]
 
 
 def int2ip(val):
-    vals = [((val & (0xFF << (step * 8))) >> (step * 8)) for step in range(4)][::-1]
-    return ".".join(map(str, vals))
+    return socket.inet_ntoa(struct.pack("!I", val))
+
+
+NETMASKS = [(0xFFFFFFFF << (32 - netsz)) & 0xFFFFFFFF for netsz in range(33)]
+NETMASK_STRS = [int2ip(mask) for mask in NETMASKS]
+NETMASK_SIZES = dict((mask, netsz) for netsz, mask in enumerate(NETMASKS))
 
 
 def netmask2netsz(netmask):
     nv = ip2int(netmask)
-    for pos in range(33):
-        if ((nv >> pos) % 2 != 0):
-            break
-    return 32 - pos
+    try:
+        return NETMASK_SIZES[nv]
+    except KeyError:
+        # not contiguous mask - count from lowest set bit
+        return 33 - (nv & -nv).bit_length()
 
 
 def netsz2netmask(netsz):
-    res = 0
-    for pos in range(netsz):
-        res = res | 1 << (31 - pos)
-    return int2ip(res)
+    return NETMASK_STRS[netsz]
+
+
+@contextlib.contextmanager
+def file_lock(fname):
+    """exclusive flock on fname + '.lock' for with block
+
+    serializes read-modify-write of shared state files between processes"""
+    dname = os.path.dirname(os.path.abspath(fname))
+    if not os.path.isdir(dname):
+        os.makedirs(dname)
+    fd = os.open(fname + '.lock', os.O_RDWR | os.O_CREAT, 0600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+@contextlib.contextmanager
+def atomic_write(fname, mode='w', dir_mode=0777):
+    """file object for with block, which content replaces fname on exit
+
+    readers never see partially written file. Missing directory is
+    created, IOError/OSError are left to caller"""
+    dname = os.path.dirname(os.path.abspath(fname))
+    if not os.path.isdir(dname):
+        os.makedirs(dname, dir_mode)
+    tmp_fname = "{0}.{1}.tmp".format(fname, os.getpid())
+    try:
+        with open(tmp_fname, mode) as fd:
+            yield fd
+        os.rename(tmp_fname, fname)
+    finally:
+        if os.path.exists(tmp_fname):
+            os.unlink(tmp_fname)
+
+
+def log_owner():
+    """thread, on behalf of which current thread works
+
+    run_parallel workers belong to thread, which started them, so
+    log records of one request can be collected from all its threads"""
+    thread = threading.current_thread()
+    return getattr(thread, 'log_owner', thread)
+
+
+def run_parallel(func, items, workers=1, name=str):
+    """Call func(item) for each item using up to workers threads.
+
+    Never raises - returns list of TaskResult objects in items order,
+    failed calls have error set to raised exception"""
+
+    items = list(items)
+    results = [None] * len(items)
+    tasks = Queue.Queue()
+
+    for pos, item in enumerate(items):
+        tasks.put((pos, item))
+
+    def worker():
+        while True:
+            try:
+                pos, item = tasks.get_nowait()
+            except Queue.Empty:
+                return
+
+            tstart = time.time()
+            try:
+                res = TaskResult(name(item), result=func(item))
+            except Exception as err:
+                logger.debug("Task for {0} failed".format(name(item)), exc_info=True)
+                res = TaskResult(name(item), error=err)
+            res.time = time.time() - tstart
+            results[pos] = res
+
+    workers = max(1, min(workers, len(items)))
+    if workers == 1:
+        worker()
+    else:
+        threads = [threading.Thread(target=worker) for _ in range(workers)]
+        owner = log_owner()
+        for th in threads:
+            th.daemon = True
+            th.log_owner = owner
+            th.start()
+        for th in threads:
+            th.join()
+
+    return results
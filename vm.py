@@ -16,91 +16,251 @@
 # along with tiny_cloud; if not, write to the Free Software Foundation, Inc.,
 # 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA.
 
-import re
 import time
 import stat
 import os.path
-import subprocess
-from xml.etree.ElementTree import fromstring, tostring, Element
+import threading
+from xml.etree.ElementTree import fromstring, tostring, Element, SubElement
 
 import libvirt
 
 import xmlbuilder
 
-from network import login_ssh, get_vm_ips, get_vm_ssh_ip, ifconfig, get_network_bridge
-from utils import ip2int, int2ip, netsz2netmask, netmask2netsz, logger
-from common import CloudError
-from disk_image import prepare_guest
+from network import login_ssh, get_vm_ips, get_vm_ssh_ip, ifconfig, get_network_bridge, \
+                    neighbours, SSHProber, MacAllocator, domain_macs
+from utils import netmask2netsz, logger, run_parallel
+from common import CloudError, TaskResult
+from disk_image import prepare_guest, image_info, PreparePool, OverlayPool
+from image_store import ImageStore
+from ipam import IPAM
+# VM and Network are re-exported for old users of vm module
+from inventory import VM, Network, Inventory, load_vms
 
 
 #suppress libvirt error messages to console
 libvirt.registerErrorHandler(lambda x, y: 1, None)
 
 
-class VM(object):
-    eth_re = re.compile(r"eth\d+")
+event_loop_lock = threading.Lock()
+event_loop_ok = None
 
-    class NetParams(object):
-        mac_re = re.compile(':'.join([r"[\da-fA-F][\da-fA-F]"] * 6))
-        ip_re = re.compile(r"\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}")
-        network_re = re.compile(r"[a-zA-Z_][-\w_]*")
 
-    def __init__(self, name, **keys):
-        self.name = name
-        self.mem = int(keys.pop('mem', 1024))
-        self.htype = keys.pop('htype', 'kvm')
-        self.vcpu = int(keys.pop('vcpu', 1))
+def run_event_loop():
+    while True:
+        libvirt.virEventRunDefaultImpl()
+
+
+def start_event_loop():
+    """Register default libvirt event loop and run it in background thread
+
+    Only connections, opened after this call, deliver events.
+    Returns False if libvirt can't provide events"""
+    global event_loop_ok
+
+    with event_loop_lock:
+        if event_loop_ok is None:
+            try:
+                libvirt.virEventRegisterDefaultImpl()
+            except (AttributeError, libvirt.libvirtError) as err:
+                logger.debug("Can't register libvirt event loop - {0}".format(err))
+                event_loop_ok = False
+            else:
+                th = threading.Thread(target=run_event_loop, name='libvirt-events')
+                th.daemon = True
+                th.start()
+                event_loop_ok = True
+    return event_loop_ok
+
+
+class DomainTemplate(object):
+    """Domain xml template, compiled to text pieces
+
+    Rendering is string concatenation - vm elements are inserted
+    at the end of <devices> and at the end of root element"""
+
+    DEVS_MARK = 'tcloud-devices'
+    ROOT_MARK = 'tcloud-root'
+
+    def __init__(self, xml_text):
+        root = fromstring(xml_text)
+        devs = root.find('devices')
+        if devs is None:
+            devs = SubElement(root, 'devices')
+        devs.append(Element(self.DEVS_MARK))
+        root.append(Element(self.ROOT_MARK))
+
+        text = tostring(root)
+        head, rest = text.split(tostring(Element(self.DEVS_MARK)))
+        middle, tail = rest.split(tostring(Element(self.ROOT_MARK)))
+        self.parts = (head, middle, tail)
+
+    def render(self, devices, elements):
+        "devices and elements are lists of xml strings"
+        head, middle, tail = self.parts
+        return "".join([head] + devices + [middle] + elements + [tail])
+
+
+class TemplateCache(object):
+    """Compiled domain xml templates
+
+    Template file is parsed once and recompiled only after its mtime changes"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.templates = {}
+
+    def get(self, path):
+        mtime = os.stat(path).st_mtime
+        with self.lock:
+            cached = self.templates.get(path)
+            if cached is None or cached[0] != mtime:
+                logger.debug("Parse template '{0}'".format(path))
+                with open(path) as fd:
+                    cached = (mtime, DomainTemplate(fd.read()))
+                self.templates[path] = cached
+        return cached[1]
+
+
+template_cache = TemplateCache()
+
+
+class ConnectionPool(object):
+    """Shared libvirt connections - one per hypervisor url
+
+    Libvirt connections are thread-safe, so all threads use the same
+    connection. Connection is checked before hand out and reopened,
+    if it was broken"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.url_locks = {}
+        self.conns = {}
+        self.opened = 0
+        self.reused = 0
+
+    @staticmethod
+    def is_alive(conn):
+        try:
+            return conn.isAlive() == 1
+        except AttributeError:
+            # libvirt before 0.9.8
+            try:
+                conn.getLibVersion()
+                return True
+            except libvirt.libvirtError:
+                return False
+        except libvirt.libvirtError:
+            return False
+
+    def get(self, url):
+        with self.lock:
+            url_lock = self.url_locks.setdefault(url, threading.Lock())
+
+        with url_lock:
+            conn = self.conns.get(url)
+            if conn is not None:
+                if self.is_alive(conn):
+                    self.reused += 1
+                    return conn
+
+                logger.warning("Connection to {0} is broken - reconnect".format(url))
+                del self.conns[url]
+                try:
+                    conn.close()
+                except libvirt.libvirtError:
+                    pass
+
+            # events are delivered only for connections opened after loop registration
+            start_event_loop()
+            conn = libvirt.open(url)
+            self.opened += 1
+            self.conns[url] = conn
+            return conn
+
+    def close(self):
+        with self.lock:
+            conns = self.conns.items()
+            self.conns = {}
+
+        for url, conn in conns:
+            try:
+                conn.close()
+            except libvirt.libvirtError as err:
+                logger.debug("Error while closing connection to {0} - {1}".format(url, err))
+
+        logger.debug("Libvirt connections opened {0} times, reused {1} times".format(
+                                    self.opened, self.reused))
 
-        credentials = keys.pop('credentials', 'root:root')
-        self.user, self.passwd = credentials.split(':')
-        if 'image' in keys:
-            self.images = [keys.pop('image')]
-        else:
-            self.images = keys.pop('images')
-        self.opts = [i.strip() for i in keys.pop('opts', "").split()]
-
-        self.__dict__.update(keys)
-
-    def eths(self):
-        for k, v in self.__dict__.items():
-            if self.eth_re.match(k):
-                params = v.split(',')
-                res = {'name': k,
-                       'network': 'default'}
-                for param in params:
-                    param = param.strip()
-                    ok = False
-                    for k, v in self.NetParams.__dict__.items():
-                        if k.endswith('_re'):
-                            if v.match(param):
-                                res[k[:-len('_re')]] = param
-                                ok = True
-                                break
-                    if not ok:
-                        raise ValueError("Can't categorize network parameter {0!r}".format(param))
-                yield res
-
-    def __str__(self):
-        return "VM({0!r})".format(self.name)
-
-    def __repr__(self):
-        return str(self)
-
-
-class Network(object):
-    def __init__(self, name, **data):
-        ip_range = data['range']
-        self.ip1, ip2_sz = ip_range.split('-')
-        self.ip2, self.sz = ip2_sz.split('/')
-        self.ip1 = self.ip1.strip()
-        self.ip2 = self.ip2.strip()
-        self.sz = int(self.sz)
-        self.url = data.get('url', 'qemu:///system')
-
-        self.name = name
-        self.ip = int2ip(ip2int(self.ip1) + 1)
-        self.bridge = data['bridge'].strip()
-        self.netmask = netsz2netmask(self.sz)
+
+class DomainWaiter(object):
+    """Wait for domains stop
+
+    Wakes up on libvirt lifecycle events, if connection provides them,
+    and falls back to adaptive polling otherwise"""
+
+    min_poll = 0.05
+    max_poll = 0.5
+    # safety net for lost events
+    max_event_poll = 5
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.cond = threading.Condition()
+        self.events = 0
+        self.seen_events = 0
+        self.poll = self.min_poll
+        self.cb_id = None
+
+        if start_event_loop():
+            try:
+                self.cb_id = conn.domainEventRegisterAny(None,
+                                    libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                                    self.on_lifecycle, None)
+            except libvirt.libvirtError as err:
+                logger.debug("Can't subscribe to domain events - {0}".format(err))
+
+    def on_lifecycle(self, conn, dom, event, detail, opaque):
+        if event in (libvirt.VIR_DOMAIN_EVENT_STOPPED,
+                     libvirt.VIR_DOMAIN_EVENT_UNDEFINED):
+            with self.cond:
+                self.events += 1
+                self.cond.notify_all()
+
+    def is_stopped(self, name):
+        try:
+            return not self.conn.lookupByName(name).isActive()
+        except libvirt.libvirtError:
+            return True
+
+    def stopped(self, names):
+        with self.cond:
+            self.seen_events = self.events
+        return [name for name in names if self.is_stopped(name)]
+
+    def reset_poll(self):
+        self.poll = self.min_poll
+
+    def wait(self, deadline):
+        "wait till next event, poll time or deadline, whatever comes first"
+        with self.cond:
+            timeout = min(self.poll, deadline - time.time())
+            if self.events == self.seen_events and timeout > 0:
+                self.cond.wait(timeout)
+
+            if self.events != self.seen_events:
+                self.poll = self.min_poll
+            elif self.cb_id is not None:
+                self.poll = min(self.poll * 2, self.max_event_poll)
+            else:
+                self.poll = min(self.poll * 2, self.max_poll)
+
+    def close(self):
+        if self.cb_id is not None:
+            try:
+                self.conn.domainEventDeregisterAny(self.cb_id)
+            except libvirt.libvirtError:
+                pass
+            self.cb_id = None
 
 
 class TinyCloud(object):
@@ -109,12 +269,32 @@ class TinyCloud(object):
                  urls, root, **defaults):
 
         self.urls = urls
-        self.vms = {}
         self.templates = templates
-        self.add_vms(vms)
+        if isinstance(vms, Inventory):
+            self.vms = vms
+        else:
+            self.vms = Inventory(separator=self.DOM_SEPARATOR)
+            self.add_vms(vms)
         self.root = root
-        self.networks = [Network(name, **data)
-                         for name, data in networks.items()]
+        self.networks = dict((name, data if isinstance(data, Network) else Network(name, **data))
+                             for name, data in networks.items())
+        self.conns = ConnectionPool()
+
+        # created by get_overlays on first start of vm with 'overlay' option
+        self.overlays = None
+        self.overlays_lock = threading.Lock()
+
+        if 'image_store' in defaults:
+            self.image_store = ImageStore(defaults['image_store'])
+        else:
+            self.image_store = None
+
+        self.ipam = None
+        self.ip_conflicts = None
+        self.macs = None
+
+        if 'neighbour_ttl' in defaults:
+            neighbours.ttl = float(defaults['neighbour_ttl'])
         msg = "Cloud with {0} vm templates created".format(self.vms.keys())
         logger.debug(msg)
         self.defaults = defaults
@@ -122,46 +302,83 @@ class TinyCloud(object):
     DOM_SEPARATOR = '.'
 
     def add_vm(self, name, **params):
-        self.vms[name] = VM(name, **params)
+        self.vms.add(VM(name, **params))
 
     def add_vms(self, vms, prefix=""):
-        for k, v in vms.items():
-            if not isinstance(v, dict):
-                continue
-
-            if v.get('type', 'vm') == 'network':
-                self.add_vms(v, prefix=prefix + k + self.DOM_SEPARATOR)
-            else:
-                self.vms[prefix + k] = VM(prefix + k, **v)
+        self.vms.update(load_vms(vms, prefix, self.DOM_SEPARATOR))
 
     def __iter__(self):
         return iter(self.vms)
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, x, y, z):
+        self.close()
+
+    def close(self):
+        self.conns.close()
+        if self.overlays is not None:
+            self.overlays.close()
+
     def get_vm_conn(self, vmname):
-        return libvirt.open(self.urls[self.vms[vmname].htype])
+        return self.conns.get(self.urls[self.vms[vmname].htype])
 
     def get_vm_ssh_ip(self, vmname):
-        return get_vm_ssh_ip(self.get_vm_conn(vmname), vmname)
+        return get_vm_ssh_ip(self.get_vm_conn(vmname), vmname,
+                             self.defaults.get('ip_method', 'auto'))
 
     def get_vm_ips(self, vmname):
-        return get_vm_ips(self.get_vm_conn(vmname), vmname)
+        return get_vm_ips(self.get_vm_conn(vmname), vmname,
+                          self.defaults.get('ip_method', 'auto'))
 
-    def start_net(self, name):
-        logger.info("Start network " + name)
+    def wait_ssh(self, vmnames, timeout):
+        """yields (vmname, ip) as soon as vm accepts ssh connections
+        and (vmname, None) for vm's, which don't do it in timeout"""
+        def resolve(vmname):
+            try:
+                return list(self.get_vm_ips(vmname))
+            except libvirt.libvirtError:
+                return []
+
+        return SSHProber(resolve).probe(vmnames, timeout)
 
+    def get_net_conn(self, name):
         if name in self.networks:
-            conn = libvirt.open(self.urls[self.networks[name].htype])
-        else:
-            conn = libvirt.open(self.def_connection)
+            return self.conns.get(self.networks[name].url)
+        return self.conns.get(self.def_connection)
+
+    def net_hosts(self, name):
+        """{MAC: (host name, ip)} DHCP reservations for vm's static ip's in network
+
+        host name is full vm name with '-' instead of group separator,
+        as dnsmasq ignores names with dots, plus nic name, if vm has
+        several nics in network. Raises CloudError if names collide"""
+        hosts = {}
+        owners = {}
+        # by_network lists vm once per its nic in network
+        vms = dict((vm.name, vm) for vm in self.vms.by_network.get(name, []))
+        for _, vm in sorted(vms.items()):
+            nics = [nic for nic in vm.nics
+                    if nic.network == name and nic.ip is not None and nic.mac is not None]
+            for nic in nics:
+                host = vm.name.replace(self.DOM_SEPARATOR, '-')
+                if len(nics) > 1:
+                    host += '-' + nic.name
+                owner = "{0}:{1}".format(vm.name, nic.name)
+                if host in owners:
+                    raise CloudError("DHCP host name {0!r} of {1} and {2} in network {3!r} collide"
+                                     .format(host, owners[host], owner, name))
+                owners[host] = owner
+                hosts[nic.mac.upper()] = (host, nic.ip)
+        return hosts
+
+    def start_net(self, name):
+        logger.info("Start network " + name)
+        conn = self.get_net_conn(name)
 
         try:
             net = conn.networkLookupByName(name)
-            if not net.isActive():
-                logger.debug("Network registered in libvirt - start it")
-                net.create()
-            else:
-                logger.debug("Network already active")
-
         except libvirt.libvirtError:
             try:
                 logger.debug("No such network in libvirt")
@@ -175,194 +392,554 @@ class TinyCloud(object):
             xml.name(name)
             xml.bridge(name=net.bridge)
             with xml.ip(address=net.ip, netmask=net.netmask):
-                xml.dhcp.range(start=net.ip1, end=net.ip2)
+                with xml.dhcp:
+                    xml.range(start=net.ip1, end=net.ip2)
+                    for mac, (host, ip) in sorted(self.net_hosts(name).items()):
+                        xml.host(mac=mac, name=host, ip=ip)
 
             logger.debug("Create network")
             conn.networkCreateXML(str(xml))
+        else:
+            if not net.isActive():
+                logger.debug("Network registered in libvirt - start it")
+                self.update_net_hosts(net, name)
+                net.create()
+            else:
+                logger.debug("Network already active")
+                self.update_net_hosts(net, name)
 
-    def start_vm(self, vmname, users, prepare_image=False):
-        logger.info("Start vm/network {0} with credentials {1}".format(vmname, users))
+    def sync_net(self, name):
+        """make DHCP host reservations of network match inventory
 
-        vms = [vm for vm in self.vms.values()
-                if vm.name == vmname or
-                    vm.name.startswith(vmname +
-                                        self.DOM_SEPARATOR)]
+        running network is updated in place, without restart. Network
+        must be defined in libvirt - start_net creates it.
+        returns (added, modified, removed) host counts"""
+        conn = self.get_net_conn(name)
+        try:
+            net = conn.networkLookupByName(name)
+        except libvirt.libvirtError:
+            raise CloudError("Network {0!r} isn't defined in libvirt - start it first".format(name))
+        return self.update_net_hosts(net, name)
+
+    def update_net_hosts(self, net, name):
+        """apply difference between inventory and network <host> entries
+        with networkUpdate calls. Hosts, unknown to inventory, are kept"""
+        current = {}
+        for host in fromstring(net.XMLDesc(0)).findall('ip/dhcp/host'):
+            if 'mac' in host.attrib:
+                current[host.attrib['mac'].upper()] = (host.attrib.get('name'),
+                                                       host.attrib.get('ip'))
+
+        need = self.net_hosts(name)
+        need_ips = dict((ip, mac) for mac, (_, ip) in need.items())
+
+        # inventory macs, which moved away, and foreign hosts, which take our ips
+        remove = [mac for mac, (_, ip) in current.items()
+                  if mac not in need and (mac in self.vms.by_mac or ip in need_ips)]
+        modify = [mac for mac in need if mac in current and current[mac] != need[mac]]
+        add = [mac for mac in need if mac not in current]
+
+        # libvirt refuses to add host with name of existing one - check before any update
+        kept_names = dict((host_name, mac) for mac, (host_name, _) in current.items()
+                          if mac not in need and mac not in remove and host_name is not None)
+        for mac in modify + add:
+            if need[mac][0] in kept_names:
+                raise CloudError("DHCP host name {0!r} of {1} is used by {2} in network {3!r}"
+                                 .format(need[mac][0], mac, kept_names[need[mac][0]], name))
+
+        if not (remove or modify or add):
+            return 0, 0, 0
+
+        flags = 0
+        if net.isActive():
+            flags |= libvirt.VIR_NETWORK_UPDATE_AFFECT_LIVE
+        if net.isPersistent():
+            flags |= libvirt.VIR_NETWORK_UPDATE_AFFECT_CONFIG
+
+        updates = [(libvirt.VIR_NETWORK_UPDATE_COMMAND_DELETE, mac, current[mac]) for mac in remove]
+        updates += [(libvirt.VIR_NETWORK_UPDATE_COMMAND_MODIFY, mac, need[mac]) for mac in modify]
+        updates += [(libvirt.VIR_NETWORK_UPDATE_COMMAND_ADD_LAST, mac, need[mac]) for mac in add]
+
+        logger.debug("Update DHCP hosts of {0}: {1} removed, {2} modified, {3} added"
+                     .format(name, len(remove), len(modify), len(add)))
+        for command, mac, (host, ip) in updates:
+            host_xml = Element('host', mac=mac)
+            if host is not None:
+                host_xml.set('name', host)
+            if ip is not None:
+                host_xml.set('ip', ip)
+            net.update(command, libvirt.VIR_NETWORK_SECTION_IP_DHCP_HOST, -1,
+                       tostring(host_xml), flags)
+
+        return len(add), len(modify), len(remove)
+
+    def find_vms(self, vmname):
+        vms = self.vms.find(vmname)
         vm_names = " ".join(vm.name for vm in vms)
         logger.debug("Found next vm's, which match name glob {0}".format(vm_names))
-
+        return vms
+
+    def get_ipam(self):
+        "IPAM with all cloud networks and static addresses from config reserved"
+        if self.ipam is None:
+            ipam = IPAM(self.defaults.get('ipam_file'))
+            for net in self.networks.values():
+                ipam.add_network(net)
+            self.ip_conflicts = ipam.reserve_static(self.vms)
+
+            # vm was removed from config
+            is_alive = lambda owner: owner.rsplit(':', 1)[0] in self.vms
+            for ip in ipam.release_stale(is_alive, self.nic_owner_prefix()):
+                logger.debug("Release address {0} of removed vm".format(ip))
+            self.ipam = ipam
+        return self.ipam
+
+    def check_ips(self, vms):
+        "raise CloudError if static address of any of vms conflicts with other one"
+        self.get_ipam()
+        names = set(vm.name for vm in vms)
+        conflicts = [msg for vm_name, msg in self.ip_conflicts if vm_name in names]
+        if conflicts:
+            raise CloudError("Address conflicts: " + "; ".join(conflicts))
+
+    def get_mac_allocator(self):
+        "MacAllocator, which knows macs from config and all libvirt domains"
+        if self.macs is None:
+            macs = MacAllocator(fname=self.defaults.get('mac_file'))
+            macs.add_known(self.vms.by_mac)
+            for url in set(self.urls.values()):
+                try:
+                    macs.add_known(domain_macs(self.conns.get(url)))
+                except libvirt.libvirtError as err:
+                    logger.warning("Can't get macs of domains from {0} - {1}".format(url, err))
+
+            # vm was removed from config. Macs file is shared by all configs,
+            # so only owners of this one are checked
+            is_alive = lambda owner: owner.rsplit(':', 1)[0] in self.vms
+            for mac in macs.release_stale(is_alive, self.nic_owner_prefix()):
+                logger.debug("Release mac {0} of removed vm".format(mac))
+            self.macs = macs
+        return self.macs
+
+    def nic_owner_prefix(self):
+        "namespace of this config in shared macs and ipam files"
+        return os.path.abspath(self.root) + ":"
+
+    def nic_owner(self, vm, nic):
+        return "{0}{1}:{2}".format(self.nic_owner_prefix(), vm.name, nic.name)
+
+    def assign_macs(self, vms):
+        """give nics of vms, which have no mac in config, allocated one
+
+        vm gets the same macs on every run, till it's removed from config"""
+        nics = [(vm, nic) for vm in vms for nic in vm.nics if nic.mac is None]
+        if nics:
+            macs = self.get_mac_allocator().allocate([self.nic_owner(vm, nic)
+                                                      for vm, nic in nics])
+            for vm, nic in nics:
+                nic.mac = macs[self.nic_owner(vm, nic)]
+            # reindex by new macs
+            for vm in set(vm for vm, _ in nics):
+                self.vms.add(vm)
+
+    def assign_ips(self, vms):
+        """give nics of vms in cloud networks, which have no ip in config,
+        address from network range
+
+        vm gets the same addresses on every run, till it's removed from
+        config. DHCP hosts of running networks are updated with them"""
+        by_network = {}
         for vm in vms:
-            logger.debug("Prepare vm {0}".format(vm.name))
+            for nic in vm.nics:
+                if nic.ip is None and nic.network in self.networks:
+                    by_network.setdefault(nic.network, []).append((vm, nic))
+
+        for name, nics in sorted(by_network.items()):
+            ips = self.get_ipam().allocate(name, [self.nic_owner(vm, nic) for vm, nic in nics])
+            for vm, nic in nics:
+                nic.ip = ips[self.nic_owner(vm, nic)]
+
+            try:
+                net = self.get_net_conn(name).networkLookupByName(name)
+            except libvirt.libvirtError:
+                # start_net adds hosts, when it creates network
+                continue
+            self.update_net_hosts(net, name)
+
+    def get_image_store(self):
+        if self.image_store is None:
+            raise CloudError("No image_store in cloud config defaults")
+        return self.image_store
+
+    def dedup_images(self, vmname):
+        """turn root images of group vmname into thin overlays on one
+        stored base, made from first of them. Vm's must be stopped"""
+        vms = sorted(self.find_vms(vmname), key=lambda vm: vm.name)
+        if not vms:
+            raise CloudError("Can't found vm {0!r}".format(vmname))
+
+        running = [vm.name for vm in vms if self.is_vm_active(vm.name)]
+        if running:
+            raise CloudError("Can't dedup images of running vm's: " + ", ".join(running))
+        return self.get_image_store().dedup([vm.images[0] for vm in vms])
+
+    def gc_images(self, dry_run=False):
+        """remove stored bases, unused by any vm, overlay pool or overlay
+        in pool spool. Returns list of removed (to be removed) paths"""
+        images = [image for vm in self.vms.values() for image in vm.images]
+        overlay_pool = self.defaults.get('overlay_pool')
+        if overlay_pool is not None:
+            images.extend(overlay_pool['bases'])
+            # ready, claimed and handed out to vm's of this and other
+            # configs overlays. Spool changes concurrently, so keep only
+            # still existing files
+            for dname, _, fnames in os.walk(overlay_pool['spool']):
+                for fname in fnames:
+                    path = os.path.join(dname, fname)
+                    if fname.endswith(('.qcow2', '.claimed')) and os.path.exists(path):
+                        images.append(path)
+
+        relative = [image for image in images if not os.path.isabs(image)]
+        if relative:
+            raise CloudError("gc needs absolute image paths, got " + ", ".join(relative))
+        return self.get_image_store().gc(images, dry_run=dry_run)
+
+    def prepare_format(self):
+        "format argument of prepare_guest for kvm images"
+        if self.defaults.get('prepare_method', 'guestfs') == 'nbd':
+            return 'nbd'
+        return None
+
+    def start_vm(self, vmname, users, prepare_image=False, workers=None):
+        """Start vm or all vm's from group vmname
+
+        Up to workers vm's are started concurrently, returns list of
+        TaskResult - one per vm. Images are prepared in worker processes,
+        each vm is started as soon as its image is ready"""
+        logger.info("Start vm/network {0} with credentials {1}".format(vmname, users))
 
-            path = os.path.join(self.root, self.templates[vm.htype])
-            vm_xml_templ = open(path).read()
-            logger.info("Use template '{0}'".format(path))
+        if workers is None:
+            workers = int(self.defaults.get('start_workers', 1))
 
-            vm_xm = fromstring(vm_xml_templ)
+        all_vms = self.find_vms(vmname)
+        self.check_ips(all_vms)
+        self.assign_macs(all_vms)
+        self.assign_ips(all_vms)
 
-            el = Element('vcpu')
-            el.text = str(vm.vcpu)
-            vm_xm.append(el)
+        # vm, which can't get its overlays, fails alone
+        taken = run_parallel(self.vm_images, all_vms, workers=workers, name=lambda vm: vm.name)
+        results = dict((res.name, res) for res in taken if not res.ok)
+        images = dict((res.name, res.result) for res in taken if res.ok)
+        vms = [vm for vm in all_vms if vm.name in images]
+        prepared = {}
+        prepare_pool = None
 
-            el = Element('name')
-            el.text = vm.name
-            vm_xm.append(el)
+        try:
+            if prepare_image:
+                prepare_pool = PreparePool(self.defaults.get('prepare_workers'))
+                kvm_vms = [vm for vm in vms if vm.htype != 'lxc']
+                prepare_format = self.prepare_format()
+
+                if self.defaults.get('prepare_batch', False) and prepare_format is None:
+                    jobs = [(images[vm.name], vm.name, self.vm_users(vm, users), self.vm_eths(vm))
+                            for vm in kvm_vms]
+                    if jobs:
+                        prepared = dict(zip([vm.name for vm in kvm_vms],
+                                            prepare_pool.submit_batch(jobs)))
+                else:
+                    for vm in kvm_vms:
+                        prepared[vm.name] = prepare_pool.submit(images[vm.name][0], vm.name,
+                                                                self.vm_users(vm, users),
+                                                                self.vm_eths(vm),
+                                                                prepare_format)
+                # start threads only wait for images - don't let them delay ready vm's
+                workers = max(workers, len(vms))
+
+            start_one = lambda vm: self.start_one_vm(vm, users,
+                                                     prepared=prepared.get(vm.name),
+                                                     images=images[vm.name])
+            started = run_parallel(start_one, vms, workers=workers, name=lambda vm: vm.name)
+        finally:
+            if prepare_pool is not None:
+                prepare_pool.close()
+
+        results.update((res.name, res) for res in started)
+        return [results[vm.name] for vm in all_vms]
+
+    def vm_images(self, vm):
+        """images to start vm from
+
+        for vm with 'overlay' option images, which have pool of
+        ready overlays, are replaced with fresh overlays"""
+        if 'overlay' not in vm.opts or 'overlay_pool' not in self.defaults:
+            return vm.images
+
+        # running vm uses overlays from previous start - don't replace them
+        if self.is_vm_active(vm.name):
+            raise CloudError("VM {0} is already running".format(vm.name))
+
+        overlays = self.get_overlays()
+        images = []
+        for pos, image in enumerate(vm.images):
+            if image in overlays:
+                dst = os.path.join(overlays.spool, "{0}-{1}.qcow2".format(vm.name, pos))
+                image = overlays.take(image, dst)
+            images.append(image)
+        return images
+
+    def get_overlays(self):
+        "OverlayPool from config, created on first use, as it starts background refill"
+        with self.overlays_lock:
+            if self.overlays is None:
+                self.overlays = OverlayPool(**self.defaults['overlay_pool'])
+            return self.overlays
+
+    def is_vm_active(self, vmname):
+        try:
+            return self.get_vm_conn(vmname).lookupByName(vmname).isActive() == 1
+        except libvirt.libvirtError:
+            return False
 
-            el = Element('memory')
-            el.text = str(vm.mem * 1024)
-            vm_xm.append(el)
+    def render_vm_xml(self, vm, images=None, macs=None):
+        """returns libvirt domain xml for vm
 
-            devs = vm_xm.find('devices')
+        macs is {nic name: mac} for nics, which have no mac yet"""
+        if images is None:
+            images = vm.images
+        if macs is None:
+            macs = {}
 
-            disk_emulator = self.defaults.get('disk_emulator', 'qemu')
+        path = os.path.join(self.root, self.templates[vm.htype])
+        logger.debug("Use template '{0}'".format(path))
 
-            if 'virtio' in vm.opts:
-                bus = 'virtio'
-            else:
-                bus = 'ide'
+        templ = template_cache.get(path)
+        elements = []
+        devs = []
 
-            if 'ide' == bus:
-                dev_name_templ = 'hd'
-            elif 'scsi' == bus:
-                dev_name_templ = 'sd'
-            elif 'virtio' == bus:
-                dev_name_templ = 'vd'
+        for tag, val in (('vcpu', vm.vcpu), ('name', vm.name), ('memory', vm.mem * 1024)):
+            el = Element(tag)
+            el.text = str(val)
+            elements.append(tostring(el))
 
-            letters = [chr(ord('a') + pos) for pos in range(ord('z') - ord('a'))]
+        disk_emulator = self.defaults.get('disk_emulator', 'qemu')
 
-            for hdd_pos, image in enumerate(vm.images):
+        if 'virtio' in vm.opts:
+            bus = 'virtio'
+        else:
+            bus = 'ide'
 
-                if hdd_pos > len(letters):
-                    raise CloudError("To many HHD devices {0}".format(len(vm.images)))
-                
-                rimage = image
+        if 'ide' == bus:
+            dev_name_templ = 'hd'
+        elif 'scsi' == bus:
+            dev_name_templ = 'sd'
+        elif 'virtio' == bus:
+            dev_name_templ = 'vd'
 
-                dev_st = os.stat(rimage)
-                while stat.S_ISLNK(dev_st.st_mode):
-                    rimage = os.readlink(rimage)
-                    dev_st = os.stat(rimage)
+        letters = [chr(ord('a') + pos) for pos in range(ord('z') - ord('a'))]
 
-                dev = dev_name_templ + letters[hdd_pos]
+        for hdd_pos, image in enumerate(images):
 
-                if stat.S_ISDIR(dev_st.st_mode):
-                    hdd = xmlbuilder.XMLBuilder('filesystem', type='mount')
-                    hdd.source(dir=image)
-                    hdd.target(dir='/')
+            if hdd_pos > len(letters):
+                raise CloudError("To many HHD devices {0}".format(len(images)))
+            
+            # stat follows symlinks
+            dev_st = os.stat(image)
+            dev = dev_name_templ + letters[hdd_pos]
+
+            if stat.S_ISDIR(dev_st.st_mode):
+                hdd = xmlbuilder.XMLBuilder('filesystem', type='mount')
+                hdd.source(dir=image)
+                hdd.target(dir='/')
+            else:
+                tp = image_info(image, dev_st)['format']
+
+                if stat.S_ISBLK(dev_st.st_mode):
+                    hdd = xmlbuilder.XMLBuilder('disk', device='disk', type='block')
+                    hdd.driver(name=disk_emulator, type=tp)
+                    hdd.source(dev=image)
+                    hdd.target(bus=bus, dev=dev)
+                elif stat.S_ISREG(dev_st.st_mode):
+                    hdd = xmlbuilder.XMLBuilder('disk', device='disk', type='file')
+                    hdd.driver(name=disk_emulator, type=tp)
+                    hdd.source(file=image)
+                    hdd.target(bus=bus, dev=dev)
                 else:
-                    res = subprocess.check_output(['qemu-img', 'info', image])
-                    hdr = "file format: "
-                    tp = None
-                    for line in res.split('\n'):
-                        if line.startswith(hdr):
-                            tp = line[len(hdr):].strip()
-                    assert tp is not None
-
-                    if stat.S_ISBLK(dev_st.st_mode):
-                        hdd = xmlbuilder.XMLBuilder('disk', device='disk', type='block')
-                        hdd.driver(name=disk_emulator, type=tp)
-                        hdd.source(dev=image)
-                        hdd.target(bus=bus, dev=dev)
-                    elif stat.S_ISREG(dev_st.st_mode):
-                        hdd = xmlbuilder.XMLBuilder('disk', device='disk', type='file')
-                        hdd.driver(name=disk_emulator, type=tp)
-                        hdd.source(file=image)
-                        hdd.target(bus=bus, dev=dev)
-                    else:
-                        raise CloudError("Can't connect hdd device {0!r}".format(image))
+                    raise CloudError("Can't connect hdd device {0!r}".format(image))
+
+            devs.append(tostring(~hdd))
+
+        for nic in vm.nics:
+            edev = xmlbuilder.XMLBuilder('interface', type='network')
+            edev.source(network=nic.network)
+            edev.mac(address=nic.mac or macs[nic.name])
+            devs.append(tostring(~edev))
+
+        return templ.render(devs, elements)
+
+    def render_group_xml(self, vmname):
+        """returns {vm name: domain xml} for vm or all vm's from group vmname
+
+        nothing is allocated: nics without mac get mac, stored for them
+        by previous start, or temporary one"""
+        vms = self.find_vms(vmname)
+        nics = [(vm, nic) for vm in vms for nic in vm.nics if nic.mac is None]
+        macs = dict((vm.name, {}) for vm in vms)
+        if nics:
+            allocator = self.get_mac_allocator()
+            stored = allocator.lookup([self.nic_owner(vm, nic) for vm, nic in nics])
+            temporary = iter(allocator.temporary(len(nics) - len(stored)))
+            for vm, nic in nics:
+                mac = stored.get(self.nic_owner(vm, nic))
+                macs[vm.name][nic.name] = mac if mac is not None else next(temporary)
+        return dict((vm.name, self.render_vm_xml(vm, macs=macs[vm.name])) for vm in vms)
+
+    def vm_users(self, vm, users=None):
+        if users is None:
+            return {vm.user: vm.passwd}
+        return users
+
+    def vm_eths(self, vm):
+        "returns {eth name: (hw, ip/'dhcp', net size/None, gw/None)} for prepare_guest"
+        eths = {}
+        for nic in vm.nics:
+            if nic.ip is None:
+                eths[nic.name] = (nic.mac, 'dhcp', None, None)
+            else:
+                brdev = get_network_bridge(self.get_vm_conn(vm.name), nic.network)
+                addr = ifconfig.getAddr(brdev)
+                mask = ifconfig.getMask(brdev)
+                eths[nic.name] = (nic.mac, nic.ip, netmask2netsz(mask), addr)
+        return eths
 
-                devs.append(~hdd)
+    def start_one_vm(self, vm, users, prepare_image=False, prepared=None, images=None):
+        """start one vm, preparing its image inline if prepare_image is set
 
-            eths = {}
+        prepared is PreparedImage for image, which is prepared elsewhere,
+        images overrides vm.images"""
+        logger.debug("Prepare vm {0}".format(vm.name))
 
-            conn = self.get_vm_conn(vm.name)
+        if images is None:
+            images = self.vm_images(vm)
 
-            for eth in vm.eths():
-                edev = xmlbuilder.XMLBuilder('interface', type='network')
-                edev.source(network=eth['network'])
-                edev.mac(address=eth['mac'])
-                devs.append(~edev)
+        vm_xml = self.render_vm_xml(vm, images)
+        conn = self.get_vm_conn(vm.name)
 
-                if 'ip' not in eth:
-                    eths[eth['name']] = (eth['mac'], 'dhcp', None, None)
-                else:
-                    brdev = get_network_bridge(conn, eth['network'])
-                    addr = ifconfig.getAddr(brdev)
-                    mask = ifconfig.getMask(brdev)
-                    eths[eth['name']] = (eth['mac'], eth['ip'], netmask2netsz(mask), addr)
+        try:
+            if prepared is not None:
+                prepared.wait()
+            elif vm.htype == 'lxc':
+                prepare_guest(images[0], vm.name, self.vm_users(vm, users),
+                              self.vm_eths(vm), format='lxc')
+            elif prepare_image:
+                prepare_guest(images[0], vm.name, self.vm_users(vm, users),
+                              self.vm_eths(vm), format=self.prepare_format())
+        except CloudError as x:
+            logger.warning("Can't update image of vm {0} - {1}".format(vm.name, x))
+
+        logger.debug("Image ready - start vm {0}".format(vm.name))
+
+        conn.createXML(vm_xml, 0)
+        logger.debug("VM {0} started ok".format(vm.name))
 
-            if users is None:
-                users = {vm.user: vm.passwd}
+    def stop_vm(self, vmname, timeout1=10, timeout2=2):
+        """Stop vm or all vm's from group vmname
 
-            try:
-                if vm.htype == 'lxc':
-                    prepare_guest(vm.images[0], vm.name, users, eths, format='lxc')
-                elif prepare_image:
-                    prepare_guest(vm.images[0], vm.name, users, eths)
-            except CloudError as x:
-                print "Can't update vm image -", x
+        Shutdown is sent to all vm's at once. Vm, which isn't stopped
+        in timeout1 seconds, is destroyed and has timeout2 more seconds
+        to go away. Returns list of TaskResult - one per vm, with result
+        set to 'absent', 'shutdown' or 'destroyed'"""
 
-            logger.debug("Image ready - start vm {0}".format(vm.name))
+        logger.info("Stop vm/network {0}".format(vmname))
 
-            conn.createXML(tostring(vm_xm), 0)
-            logger.debug("VM {0} started ok".format(vm.name))
-            conn.close()
+        vms = self.find_vms(vmname)
+        by_url = {}
+        for xvm in vms:
+            by_url.setdefault(self.urls[xvm.htype], []).append(xvm)
+
+        urls = list(by_url)
+        stop_group = lambda url: self.stop_vms(url, by_url[url], timeout1, timeout2)
+        results = {}
+        for url, res in zip(urls, run_parallel(stop_group, urls, workers=len(urls))):
+            if res.ok:
+                results.update((vm_res.name, vm_res) for vm_res in res.result)
+            else:
+                # e.g. hypervisor is unreachable - all its vm's failed
+                results.update((xvm.name, TaskResult(xvm.name, error=res.error, time=res.time))
+                               for xvm in by_url[url])
 
-    def stop_vm(self, vmname, timeout1=10, timeout2=2):
+        return [results[xvm.name] for xvm in vms]
 
-        logger.info("Stop vm/network {0}".format(vmname))
+    def stop_vms(self, url, vms, timeout1, timeout2):
+        conn = self.conns.get(url)
+        waiter = DomainWaiter(conn)
 
-        vms = [vm for vm in self.vms.values()
-                if vm.name == vmname or
-                   vm.name.startswith(vmname + self.DOM_SEPARATOR)]
+        try:
+            tstart = time.time()
+            results = {}
+            doms = {}
+            stages = {}
+            deadlines = {}
 
-        vm_names = " ".join(vm.name for vm in vms)
-        logger.debug("Found next vm's, which match name glob {0}".format(vm_names))
+            for xvm in vms:
+                try:
+                    dom = conn.lookupByName(xvm.name)
+                except libvirt.libvirtError:
+                    logger.debug("vm {0} don't exists - skip it".format(xvm.name))
+                    results[xvm.name] = TaskResult(xvm.name, result='absent')
+                    continue
 
-        for xvm in vms:
-            conn = self.get_vm_conn(xvm.name)
-            logger.debug("Stop vm {0}".format(xvm.name))
-            
-            try:
-                vm = conn.lookupByName(xvm.name)
-            except libvirt.libvirtError:
-                logger.debug("vm {0} don't exists - skip it".format(xvm.name))
-            else:
                 logger.debug("Shutdown vm {0}".format(xvm.name))
-                
+                doms[xvm.name] = dom
+                stages[xvm.name] = 'shutdown'
                 try:
-                    vm.shutdown()
+                    dom.shutdown()
+                    deadlines[xvm.name] = tstart + timeout1
                 except libvirt.libvirtError:
-                    pass
-                else:
-                    for i in range(timeout1):
-                        time.sleep(1)
+                    deadlines[xvm.name] = tstart
+
+            while deadlines:
+                for name in waiter.stopped(deadlines):
+                    logger.debug("VM {0} stopped".format(name))
+                    results[name] = TaskResult(name, result=stages[name],
+                                               time=time.time() - tstart)
+                    del deadlines[name]
+
+                ctime = time.time()
+                for name, deadline in deadlines.items():
+                    if ctime < deadline:
+                        continue
+
+                    if stages[name] == 'shutdown':
+                        logger.warning("VM {0} don't shoutdowned - destroy it".format(name))
+                        stages[name] = 'destroyed'
+                        deadlines[name] = ctime + timeout2
                         try:
-                            vm = conn.lookupByName(xvm.name)
+                            doms[name].destroy()
                         except libvirt.libvirtError:
-                            return
+                            pass
+                        waiter.reset_poll()
+                    else:
+                        logger.error("Can't stop vm {0}".format(name))
+                        results[name] = TaskResult(name, time=ctime - tstart,
+                                                   error=CloudError("Can't stop vm {0}".format(name)))
+                        del deadlines[name]
 
-                logger.warning("VM {0} don't shoutdowned - destroy it".format(xvm.name))
-                vm.destroy()
-                for i in range(timeout2):
-                    time.sleep(1)
-                    try:
-                        vm = conn.lookupByName(xvm.name)
-                    except libvirt.libvirtError:
-                        return
+                if deadlines:
+                    waiter.wait(min(deadlines.values()))
+        finally:
+            waiter.close()
 
-                logger.error("Can't stop vm {0}".format(xvm.name))
-                raise CloudError("Can't stop vm {0}".format(xvm.name))
-            conn.close()
+        return [results[xvm.name] for xvm in vms]
 
     def list_vms(self):
         for url in self.urls.values():
-            conn = libvirt.open(url)
+            conn = self.conns.get(url)
             for domain_id in conn.listDomainsID():
                 yield conn.lookupByID(domain_id)
-            conn.close()
 
     def login_to_vm(self, vmname, users=None):
         vm = self.vms[vmname]
-        ipaddr = get_vm_ssh_ip(self.get_vm_conn(vmname), vmname)
+        ipaddr = self.get_vm_ssh_ip(vmname)
         if ipaddr is None:
             raise CloudError("No one interface of {0} accepts ssh connection".format(vmname))
         else: